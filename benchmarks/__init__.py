@@ -0,0 +1,4 @@
+"""
+Benchmarks for permission queries. These run against the test app's
+models, on a throwaway database created from the test settings.
+"""
@@ -0,0 +1,229 @@
+import fractions
+import os
+import random
+import time
+
+import django
+
+"""
+Database setup
+"""
+
+
+def setup():
+    """
+    Configures Django and creates a fresh database to benchmark against.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    django.setup()
+
+    from django.db import connection
+    return connection.creation.create_test_db(verbosity=0)
+
+
+def teardown(old_name):
+    from django.db import connection
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+"""
+Seeding
+"""
+
+
+def _create(model, objects):
+    # Not every backend returns pks from bulk_create, so fetch them after
+    last_pk = model.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+    last_pk = last_pk[0] if last_pk else 0
+
+    model.objects.bulk_create(objects)
+
+    return list(
+        model.objects
+        .filter(pk__gt=last_pk)
+        .order_by('pk')
+        .values_list('pk', flat=True)
+    )
+
+
+def _get_step(space, rand):
+    """
+    Gets a step coprime with space, so that (i * step) % space visits
+    every slot exactly once without keeping track of which were used.
+    """
+    while True:
+        step = rand.randrange(1, space) if space > 1 else 1
+        if fractions.gcd(step, space) == 1:
+            return step
+
+
+def seed(
+    permissions,
+    zoos=10,
+    exhibits_per_zoo=10,
+    animals_per_exhibit=10,
+    users=None,
+    groups=100,
+    members=100,
+    groups_per_member=10,
+    random_seed=0
+):
+    """
+    Fills the test app's tables. Permissions are spread over users, groups
+    and public grants on zoos and exhibits, and are generated in batches so
+    memory stays flat however many are requested. The first members users
+    each belong to groups_per_member groups. Returns the number of
+    Permissions created.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from flexible_permissions.models import Permission
+    from tests.models import User, Group, Zoo, Exhibit, Animal
+
+    rand = random.Random(random_seed)
+    users = users or max(1000, permissions // 50)
+
+    # Zoos have no columns to bulk insert
+    zoo_ids = [Zoo.objects.create().pk for i in range(zoos)]
+    exhibit_ids = _create(Exhibit, [
+        Exhibit(zoo_id=zoo_id)
+        for zoo_id in zoo_ids
+        for i in range(exhibits_per_zoo)
+    ])
+    _create(Animal, [
+        Animal(exhibit_id=exhibit_id)
+        for exhibit_id in exhibit_ids
+        for i in range(animals_per_exhibit)
+    ])
+    user_ids = _create(User, [
+        User(name='user %s' % i) for i in range(users)
+    ])
+    group_ids = _create(Group, [
+        Group(name='group %s' % i) for i in range(groups)
+    ])
+
+    Membership = Group.user_set.through
+    Membership.objects.bulk_create([
+        Membership(user_id=user_id, group_id=group_id)
+        for user_id in user_ids[:members]
+        for group_id in rand.sample(
+            group_ids,
+            min(groups_per_member, len(group_ids))
+        )
+    ])
+
+    zoo_type_id = ContentType.objects.get_for_model(Zoo).id
+    exhibit_type_id = ContentType.objects.get_for_model(Exhibit).id
+    user_type_id = ContentType.objects.get_for_model(User).id
+    group_type_id = ContentType.objects.get_for_model(Group).id
+
+    targets = (
+        [('zoo.admin', zoo_type_id, pk) for pk in zoo_ids] +
+        [('exhibit.staff', exhibit_type_id, pk) for pk in exhibit_ids]
+    )
+    agents = (
+        [(None, None)] +
+        [(user_type_id, pk) for pk in user_ids] +
+        [(group_type_id, pk) for pk in group_ids]
+    )
+
+    space = len(targets) * len(agents)
+    permissions = min(permissions, space)
+    step = _get_step(space, rand)
+
+    for offset in range(0, permissions, 10000):
+        rows = []
+        for i in range(offset, min(offset + 10000, permissions)):
+            slot = (i * step) % space
+            role, target_type_id, target_id = targets[slot % len(targets)]
+            agent_type_id, agent_id = agents[slot // len(targets)]
+
+            rows.append(Permission(
+                role=role,
+                agent_type_id=agent_type_id,
+                agent_id=agent_id,
+                target_type_id=target_type_id,
+                target_id=target_id
+            ))
+
+        Permission.objects.bulk_create(rows)
+
+    return permissions
+
+
+"""
+Measuring
+"""
+
+
+def time_queryset(queryset, repeat=20):
+    """
+    Evaluates a fresh copy of queryset repeat times, returning the
+    duration of each run in milliseconds.
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.time()
+        list(queryset.all())
+        durations.append((time.time() - start) * 1000)
+
+    return durations
+
+
+def explain(queryset):
+    """
+    Returns the database's query plan for queryset as a list of lines.
+    """
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+
+    if connection.vendor == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    elif connection.vendor == 'postgresql':
+        sql = 'EXPLAIN ANALYZE ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+    return [
+        ' '.join(str(column) for column in row)
+        for row in cursor.fetchall()
+    ]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+
+    return values[index]
+
+
+def measure(fn, repeat=20):
+    """
+    Calls fn once while capturing its queries, then repeat more times for
+    timing. Returns latency percentiles in milliseconds, the number of
+    queries, and the total length of their SQL.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as context:
+        fn()
+
+    durations = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        durations.append((time.time() - start) * 1000)
+
+    return {
+        'p50': percentile(durations, 50),
+        'p90': percentile(durations, 90),
+        'p99': percentile(durations, 99),
+        'queries': len(context.captured_queries),
+        'sql_size': sum(
+            len(query['sql']) for query in context.captured_queries
+        ),
+    }
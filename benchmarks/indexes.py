@@ -0,0 +1,76 @@
+"""
+Compares query plans and timings for the main permission queries with and
+without the indexes added in flexible_permissions 0002.
+
+    python -m benchmarks.indexes [permissions] [repeat]
+"""
+import sys
+
+from importlib import import_module
+
+from benchmarks.base import setup, teardown, seed, time_queryset, explain
+
+
+def get_querysets():
+    from flexible_permissions.models import Permission
+    from tests.models import User, Zoo, Animal
+
+    user = User.objects.get(pk=Permission.objects.filter(
+        agent_type__model='user'
+    ).values_list('agent_id', flat=True)[0])
+    zoo = Zoo.objects.first()
+
+    return [
+        ('Zoo.for_role', Zoo.objects.for_role('zoo.admin', user)),
+        ('Animal.for_action', Animal.objects.for_action('feed', user)),
+        ('User.with_role', User.objects.with_role('zoo.admin', zoo)),
+    ]
+
+
+def set_indexes(enabled):
+    from django.db import connection
+    from flexible_permissions.models import Permission
+
+    migration = import_module(
+        'flexible_permissions.migrations.0002_permission_indexes'
+    )
+    index_together = Permission._meta.index_together
+
+    with connection.schema_editor() as editor:
+        if enabled:
+            editor.alter_index_together(Permission, [], index_together)
+            migration.create_public_index(None, editor)
+        else:
+            # SQLite rebuilds the table on alter, so drop this one first
+            migration.drop_public_index(None, editor)
+            editor.alter_index_together(Permission, index_together, [])
+
+
+def report(title, repeat):
+    print '== %s ==' % title
+
+    for name, queryset in get_querysets():
+        durations = sorted(time_queryset(queryset, repeat))
+        print '%s: median %.2fms' % (name, durations[len(durations) // 2])
+
+        for line in explain(queryset):
+            print '    %s' % line
+
+
+def main(permissions=100000, repeat=20):
+    old_name = setup()
+
+    try:
+        print 'Seeded %s permissions' % seed(permissions)
+
+        set_indexes(False)
+        report('Without indexes', repeat)
+
+        set_indexes(True)
+        report('With indexes', repeat)
+    finally:
+        teardown(old_name)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,19 @@
+import os
+
+from tests.test_settings import *
+
+"""
+Benchmarks run on SQLite unless BENCHMARK_POSTGRES_NAME names a local
+PostgreSQL database to use instead.
+"""
+if os.environ.get('BENCHMARK_POSTGRES_NAME'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': os.environ['BENCHMARK_POSTGRES_NAME'],
+            'USER': os.environ.get('BENCHMARK_POSTGRES_USER', ''),
+            'PASSWORD': os.environ.get('BENCHMARK_POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('BENCHMARK_POSTGRES_HOST', ''),
+            'PORT': os.environ.get('BENCHMARK_POSTGRES_PORT', ''),
+        }
+    }
@@ -0,0 +1,107 @@
+"""
+Measures the permission APIs against datasets of increasing size.
+
+    python -m benchmarks.suite --sizes 1000,10000,100000 --json out.json
+
+The most connected users belong to --groups-per-member groups, hundreds
+by default, so agent expansion is measured at a realistic size.
+
+Set BENCHMARK_POSTGRES_NAME to run against a local PostgreSQL database.
+"""
+import argparse
+import json
+import sys
+
+from benchmarks.base import setup, teardown, seed, measure
+
+
+def get_scenarios(repeat):
+    """
+    Returns (name, fn) pairs for every API being measured. Each one is
+    called repeat + 1 times.
+    """
+    from django.db.models import Count
+    from flexible_permissions.shortcuts import ANY, add_perm, get_perms
+    from tests.models import User, Zoo, Exhibit, Animal
+
+    zoo = Zoo.objects.first()
+    member = (
+        User.objects
+        .annotate(group_count=Count('group'))
+        .order_by('-group_count')
+        .first()
+    )
+    loner = User.objects.filter(group__isnull=True).order_by('pk').last()
+
+    # Fresh exhibits, so every add_perm call inserts a row
+    exhibits = iter([
+        Exhibit.objects.create(zoo=zoo) for i in range(repeat + 1)
+    ])
+
+    def add_next_perm():
+        add_perm('exhibit.staff', loner, next(exhibits))
+
+    return [
+        ('for_role', lambda: list(
+            Zoo.objects.for_role('zoo.admin', loner)
+        )),
+        ('for_role (many groups)', lambda: list(
+            Zoo.objects.for_role('zoo.admin', member)
+        )),
+        ('for_action (deep relation)', lambda: list(
+            Animal.objects.for_action('feed', member)
+        )),
+        ('with_role', lambda: list(
+            User.objects.with_role('zoo.admin', zoo)
+        )),
+        ('get_perms', lambda: list(get_perms(ANY, loner, ANY))),
+        ('add_perm', add_next_perm),
+    ]
+
+
+def run(size, repeat, groups, groups_per_member):
+    old_name = setup()
+
+    try:
+        seed(size, groups=groups, groups_per_member=groups_per_member)
+
+        return dict(
+            (name, measure(fn, repeat))
+            for name, fn in get_scenarios(repeat)
+        )
+    finally:
+        teardown(old_name)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--groups-per-member', type=int, default=200)
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results[size] = run(
+            size,
+            args.repeat,
+            args.groups,
+            args.groups_per_member
+        )
+
+        print '== %s permissions ==' % size
+        for name, result in sorted(results[size].items()):
+            print (
+                '%(name)s: p50 %(p50).2fms p90 %(p90).2fms p99 %(p99).2fms, '
+                '%(queries)s queries, %(sql_size)s chars of SQL'
+            ) % dict(result, name=name)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1 @@
+default_app_config = 'flexible_permissions.apps.FlexiblePermissionsConfig'
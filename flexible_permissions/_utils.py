@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models import Q
 
 import operator
+import zlib
+
+from collections import OrderedDict
+from itertools import islice
 
 """
 Unique values for differentiating between
@@ -51,6 +56,52 @@ def ensure_plural(value, remove_nones=True):
     return value
 
 
+def chunked(items, size):
+    """
+    Yields lists of at most size items. Querysets are streamed rather than
+    loaded into memory all at once.
+    """
+    if not is_plural(items):
+        items = [items]
+
+    if isinstance(items, models.QuerySet):
+        items = items.iterator()
+
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+ITER_CHUNK_SIZE = 1000
+
+
+def iterate_keyset(queryset, size=ITER_CHUNK_SIZE):
+    """
+    Yields the objects of queryset in pk order, fetching size at a time
+    with a pk > last seen pk query, so memory stays bounded and deep pages
+    cost as little as the first. Repeated rows are skipped.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(page[:size])
+
+        for obj in chunk:
+            if obj.pk != last_pk:
+                last_pk = obj.pk
+                yield obj
+
+        if len(chunk) < size:
+            return
+
+
 def get_model_class(value):
     if isinstance(value, ContentType):
         model_class = value.model_class()
@@ -68,8 +119,69 @@ def get_model_class(value):
     return model_class
 
 
+"""
+Model metadata, memoized per model class. Names are loaded when the app is
+ready. Content type ids are looked up on first use, since the database may
+not exist yet then, and forgotten whenever migrations run.
+"""
+_model_names = {}
+_content_type_ids = {}
+
+
 def get_model_name(value):
-    return get_model_class(value)._meta.verbose_name.replace(' ', '_')
+    model_class = get_model_class(value)
+
+    if model_class not in _model_names:
+        _model_names[model_class] = (
+            model_class._meta.verbose_name.replace(' ', '_')
+        )
+
+    return _model_names[model_class]
+
+
+def get_content_type_id(value):
+    model_class = get_model_class(value)
+
+    if model_class not in _content_type_ids:
+        _content_type_ids[model_class] = (
+            ContentType.objects.get_for_model(model_class).id
+        )
+
+    return _content_type_ids[model_class]
+
+
+def clear_content_type_ids(**kwargs):
+    _content_type_ids.clear()
+
+
+"""
+Role ids. Each role name maps to a stable integer, so that the role_id
+column can be filled in without coordination between processes. With
+FLEXIBLE_PERMISSIONS_ROLE_IDS set, queries compare role_id rather than role.
+"""
+
+
+def get_role_id(role):
+    return zlib.crc32(role.encode('utf-8')) & 0x7fffffff
+
+
+def use_role_ids():
+    return getattr(settings, 'FLEXIBLE_PERMISSIONS_ROLE_IDS', False)
+
+
+def get_roles_query(roles, prefix=None):
+    """
+    Creates the equivalent of an __in query on role for the given roles.
+    """
+    if use_role_ids():
+        return Q(**{
+            get_key('role_id', prefix, 'in'): [
+                get_role_id(role) for role in roles
+            ]
+        })
+
+    return Q(**{get_key('role', prefix, 'in'): roles})
+
 
 """
 Generic query building functions
@@ -100,18 +212,55 @@ def normalize_value(value, fn=ensure_plural, *args, **kwargs):
     return fn(value, *args, **kwargs) if is_value(value) else value
 
 
+"""
+The maximum number of ids in a single IN clause. Some backends limit it,
+and most plan very long lists badly.
+"""
+IN_CHUNK_SIZE = 500
+
+
+def get_in_query(key, ids):
+    """
+    Creates the equivalent of Q(key=ids), split into IN_CHUNK_SIZE lists.
+    Nothing matches an empty list.
+    """
+    return reduce(operator.or_, [
+        Q(**{key: ids[offset:offset + IN_CHUNK_SIZE]})
+        for offset in range(0, len(ids), IN_CHUNK_SIZE)
+    ], Q(id__isnull=True))
+
+
 def generic_in(key, items):
     """
     Creates a the equivalent of an __in query for the given items.
-    Items may be heterogeneous, but they must be Django models.
+    Items may be heterogeneous, but they must be Django models. A single
+    item is treated as a list of one.
+
+    Items are grouped by model, producing one (type = x AND id IN (...))
+    clause per ContentType. A queryset is used as a subquery instead of
+    being fetched.
     """
-    clauses = [
-        Q(**{
-            "%s_id" % key: item.id,
-            "%s_type" % key: ContentType.objects.get_for_model(item),
+    type_key = "%s_type_id" % key
+    id_key = "%s_id__in" % key
+
+    if isinstance(items, models.QuerySet):
+        return Q(**{
+            type_key: get_content_type_id(items.model),
+            id_key: items.values('pk'),
         })
-        for item in items
-    ]
+
+    items = ensure_plural(items)
+
+    ids_by_model = OrderedDict()
+    for item in items:
+        ids_by_model.setdefault(item._meta.concrete_model, []).append(item.pk)
+
+    clauses = []
+    for model, ids in ids_by_model.items():
+        clauses.append(
+            Q(**{type_key: get_content_type_id(model)}) &
+            get_in_query(id_key, ids)
+        )
 
     # Match nothing for base query
     return reduce(operator.or_, clauses, Q(**{'id__isnull': True}))
@@ -121,6 +270,10 @@ def validate_roles_with_targets(roles, targets):
     if not is_value(roles) or not is_value(targets):
         return
 
+    # A queryset is checked by its model rather than fetched
+    if isinstance(targets, models.QuerySet):
+        targets = targets.model
+
     for target in normalize_value(targets):
         target_name = get_model_name(target)
 
@@ -142,6 +295,8 @@ def get_single_crud_kwargs(role, agent, target):
 
     if role is NULL:
         kwargs['role__isnull'] = True
+    elif is_value(role) and use_role_ids():
+        kwargs['role_id'] = get_role_id(role)
     elif is_value(role):
         kwargs['role'] = role
 
@@ -149,7 +304,7 @@ def get_single_crud_kwargs(role, agent, target):
         kwargs['agent_id__isnull'] = True
     elif is_value(agent):
         kwargs.update({
-            'agent_type': ContentType.objects.get_for_model(agent),
+            'agent_type_id': get_content_type_id(agent),
             'agent_id': agent.id
         })
 
@@ -157,7 +312,7 @@ def get_single_crud_kwargs(role, agent, target):
         kwargs['target_id__isnull'] = True
     elif is_value(target):
         kwargs.update({
-            'target_type': ContentType.objects.get_for_model(target),
+            'target_type_id': get_content_type_id(target),
             'target_id': target.id
         })
 
@@ -167,23 +322,24 @@ def get_single_crud_kwargs(role, agent, target):
 def get_multi_crud_query(role=NULL, agent=NULL, target=NULL):
     """
     Gets a query object for the given role, agent, and target. Any of the
-    three may be plural; a generic_in will be used.
+    three may be plural; a generic_in will be used. Querysets of agents or
+    targets become subqueries.
     """
     query = Q()
 
     if role is NULL:
         query = query & Q(role__isnull=True)
     elif is_value(role):
-        query = query & Q(role__in=ensure_plural(role))
+        query = query & get_roles_query(ensure_plural(role))
 
     if agent is NULL:
         query = query & Q(agent_id__isnull=True)
     elif is_value(agent):
-        query = query & generic_in('agent', ensure_plural(agent))
+        query = query & generic_in('agent', agent)
 
     if target is NULL:
         query = query & Q(target_id__isnull=True)
     elif is_value(target):
-        query = query & generic_in('target', ensure_plural(target))
+        query = query & generic_in('target', target)
 
     return query
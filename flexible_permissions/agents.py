@@ -1,31 +1,119 @@
+from flexible_permissions.cache import get_instance_key, get_request_cache
+from flexible_permissions.hierarchy import get_ancestors, register_parent
+from flexible_permissions.instrumentation import annotate, instrumented
 from flexible_permissions._utils import ensure_plural
 
 _agent_registry = {}
+_batch_registry = {}
+_path_registry = {}
 
 
-def register_agent(cls, get_related_agents):
+def register_agent(
+    cls,
+    get_related_agents,
+    batch_fn=None,
+    parent=None,
+    paths=()
+):
     """
     Register class function pair to get related agents.
     get_related_agents takes an agent and returns other agents
     that that agent implies. This should be used for getting
     groups from a user, for example.
+
+    batch_fn is optional. It takes a list of agents and returns a dict of
+    each agent to its related agents, ideally with a single query. If
+    given, it is used instead of get_related_agents.
+
+    parent is optional. It names a field pointing at a parent agent, whose
+    authority, and that of its own ancestors, this agent inherits.
+
+    paths are optional lookups from cls to the agents get_related_agents
+    returns, e.g. ['group'] for users. They let with_role find agents of
+    cls through permissions held by their related agents.
     """
     _agent_registry[cls] = get_related_agents
 
+    if batch_fn is None:
+        _batch_registry.pop(cls, None)
+    else:
+        _batch_registry[cls] = batch_fn
+
+    if parent is not None:
+        register_parent(cls, parent)
+
+    _path_registry[cls] = tuple(paths)
+
+
+def get_agent_paths(cls):
+    return _path_registry.get(cls, ())
+
+
+def _expand_agents(cls, agents):
+    if cls in _batch_registry:
+        expansions = _batch_registry[cls](agents)
+    else:
+        expansions = dict(
+            (agent, _agent_registry[cls](agent)) for agent in agents
+        )
+
+    return [(agent, list(expansions.get(agent, []))) for agent in agents]
+
 
+@instrumented('normalize_agent')
 def normalize_agent(agents, infer_agents=True):
     """
-    Turn an agent into a list of equivalent agents
+    Turn an agent into a list of equivalent agents.
+
+    If a cache scope is open, each agent's related agents are memoized for
+    the rest of the scope.
     """
-    result = []
-    for agent in ensure_plural(agents):
+    agents = ensure_plural(agents)
+
+    for agent in agents:
         if agent.__class__ not in _agent_registry:
             raise KeyError("%s is not registered." % agent.__class__)
 
-        # Delegate agent calculation to registered function
-        if infer_agents:
-            result += list(_agent_registry[agent.__class__](agent))
-        else:
-            result.append(agent)
+    if not infer_agents:
+        result = list(set(agents))
+        annotate(agents=len(result))
+
+        return result
+
+    cache = get_request_cache('agents')
+    if cache is None:
+        cache = {}
+
+    # Delegate agent calculation to registered functions, one call per
+    # class for everything not already known
+    pending = {}
+    for agent in agents:
+        if get_instance_key(agent) not in cache:
+            pending.setdefault(agent.__class__, []).append(agent)
+
+    expanded = []
+    for cls, pending_agents in pending.items():
+        expanded += _expand_agents(cls, pending_agents)
+
+    # Then add the ancestors of everything found so far, all at once
+    ancestors = get_ancestors(set(
+        related_agent
+        for agent, related in expanded
+        for related_agent in related
+    ))
+
+    for agent, related in expanded:
+        cache[get_instance_key(agent)] = related + [
+            ancestor
+            for related_agent in related
+            for ancestor in ancestors.get(get_instance_key(related_agent), [])
+        ]
+
+    result = set()
+    for agent in agents:
+        result.update(cache[get_instance_key(agent)])
+
+    result = list(result)
+    annotate(agents=len(result))
 
-    return list(set(result))
+    return result
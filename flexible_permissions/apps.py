@@ -0,0 +1,21 @@
+from django.apps import AppConfig, apps
+from django.db.models.signals import post_migrate
+
+
+class FlexiblePermissionsConfig(AppConfig):
+    name = 'flexible_permissions'
+    verbose_name = "Flexible Permissions"
+
+    def ready(self):
+        # _utils imports ContentType, which needs the app registry loaded
+        from flexible_permissions._utils import (
+            clear_content_type_ids,
+            get_model_name,
+        )
+        from flexible_permissions.effective import connect_receivers
+
+        for model in apps.get_models():
+            get_model_name(model)
+
+        post_migrate.connect(clear_content_type_ids)
+        connect_receivers()
@@ -0,0 +1,338 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import caches
+from django.dispatch import receiver
+
+from flexible_permissions.signals import permissions_changed
+from flexible_permissions._utils import (
+    ANY,
+    NULL,
+    ensure_plural,
+    identity,
+    is_value,
+)
+
+"""
+Request scoped cache. Resolved permission queries are memoized for as long
+as a scope is open, which is normally the life of a single request.
+"""
+
+_local = threading.local()
+
+
+def open_scope():
+    """
+    Opens a cache scope. Scopes may be nested; only the outermost one
+    actually creates and discards the cache.
+    """
+    _local.depth = getattr(_local, 'depth', 0) + 1
+
+    if _local.depth == 1:
+        _local.scope = {}
+
+
+def close_scope():
+    _local.depth = max(getattr(_local, 'depth', 0) - 1, 0)
+
+    if _local.depth == 0:
+        _local.scope = None
+
+
+@contextmanager
+def permission_cache():
+    """
+    Memoize permission queries for the duration of the block.
+    """
+    open_scope()
+    try:
+        yield
+    finally:
+        close_scope()
+
+
+def get_request_cache(name):
+    """
+    Gets the named cache for the current scope, or None if no scope is open.
+    """
+    scope = getattr(_local, 'scope', None)
+
+    if scope is None:
+        return None
+
+    return scope.setdefault(name, {})
+
+
+class PermissionCacheMiddleware(object):
+    """
+    Opens a cache scope for each request.
+    """
+    def process_request(self, request):
+        open_scope()
+
+    def process_response(self, request, response):
+        close_scope()
+        return response
+
+
+"""
+Key building
+"""
+
+
+def get_instance_key(instance):
+    return (instance.__class__, instance.pk)
+
+
+def get_value_key(value, fn=identity):
+    """
+    Turns a role, agent or target argument into something hashable.
+    ANY and NULL are kept as they are.
+    """
+    if not is_value(value):
+        return value
+
+    return frozenset(fn(item) for item in ensure_plural(value))
+
+
+def get_targets_key(queryset, roles, agent, infer_agents):
+    return (
+        queryset.model,
+        queryset.db,
+        get_value_key(roles),
+        get_value_key(agent, get_instance_key),
+        infer_agents,
+    )
+
+
+"""
+Resolved targets
+"""
+
+
+class CachedTargets(object):
+    """
+    The ids a for_role call resolved to, along with the roles and the
+    normalized agents they were resolved for so that writes can find them.
+    """
+    def __init__(self, roles, agents, ids):
+        self.roles = get_value_key(roles)
+        self.agents = get_value_key(agents, get_instance_key)
+        self.ids = ids
+
+    def matches(self, roles, agents):
+        return (
+            self._matches_roles(get_value_key(roles)) and
+            self._matches_agents(get_value_key(agents, get_instance_key))
+        )
+
+    def _matches_roles(self, roles):
+        if not is_value(self.roles) or not is_value(roles):
+            return True
+
+        return bool(self.roles & roles)
+
+    def _matches_agents(self, agents):
+        # Permissions with a null agent apply to everyone
+        if self.agents is ANY or not is_value(agents):
+            return True
+
+        if self.agents is NULL:
+            return False
+
+        return bool(self.agents & agents)
+
+
+@receiver(permissions_changed)
+def invalidate_targets(sender, roles, agents, targets, **kwargs):
+    cache = get_request_cache('targets')
+
+    if not cache:
+        return
+
+    for key, entry in cache.items():
+        if entry.matches(roles, agents):
+            del cache[key]
+
+
+"""
+Shared cache. When FLEXIBLE_PERMISSIONS_CACHE names a configured cache,
+resolved ids are stored there across requests. Keys include a generation
+counter for every agent, target model and related model they depend on.
+Writes, and saves or deletes of related objects, bump those counters, so
+stale entries are simply never read again.
+"""
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'FLEXIBLE_PERMISSIONS_CACHE', None)
+
+    if alias is None:
+        return None
+
+    return caches[alias]
+
+
+def get_shared_timeout():
+    return getattr(settings, 'FLEXIBLE_PERMISSIONS_CACHE_TIMEOUT', 300)
+
+
+def get_shared_max_ids():
+    """
+    Results with more ids than this aren't worth storing; they're queried
+    again each time rather than turned into a huge IN list.
+    """
+    return getattr(settings, 'FLEXIBLE_PERMISSIONS_CACHE_MAX_IDS', 1000)
+
+
+# Stored in place of the ids of results too large to cache
+TOO_MANY_IDS = 'too many'
+
+# Writes touching more agents than this bump agent:any instead
+MAX_AGENT_GENERATIONS = 100
+
+
+def get_model_label(cls):
+    meta = cls._meta
+    return "%s.%s" % (meta.app_label, meta.model_name)
+
+
+def get_label(instance):
+    return "%s:%s" % (get_model_label(instance.__class__), instance.pk)
+
+
+def get_generation_names(agent=ANY, target=ANY, models=()):
+    """
+    Gets the generation counters a query for agent and target depends on.
+    models are the queried model and those it's related to, whose rows
+    can change the result too.
+    """
+    names = ['model:%s' % get_model_label(model) for model in models]
+
+    if agent is NULL or is_value(agent):
+        names += ['agent:any', 'agent:null']
+
+    if is_value(agent):
+        names += ['agent:%s' % get_label(item) for item in agent]
+
+    # Targets are tracked per model, so writes on many of them stay cheap
+    if is_value(target):
+        names += ['target:any']
+        names += [
+            'target:%s' % get_model_label(item.__class__) for item in target
+        ]
+
+    # Without an agent or target, any write at all is relevant
+    if not [name for name in names if not name.startswith('model:')]:
+        names.append('all')
+
+    return sorted(set(names))
+
+
+def _new_generation():
+    # Evicted counters must not restart from a value already used in a key
+    return int(time.time() * 1000000)
+
+
+def get_generations(cache, names):
+    keys = ['flexible_permissions:gen:%s' % name for name in names]
+    generations = cache.get_many(keys)
+
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _new_generation(), None)
+            generations[key] = cache.get(key)
+
+    return [generations[key] for key in keys]
+
+
+def bump_generations(cache, names):
+    for name in names:
+        key = 'flexible_permissions:gen:%s' % name
+
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_generation(), None)
+
+
+def get_shared_key(
+    cache,
+    queryset,
+    perms_name,
+    roles,
+    agent,
+    target,
+    models=()
+):
+    names = get_generation_names(agent, target, models)
+    description = repr((
+        queryset.model._meta.db_table,
+        queryset.db,
+        perms_name,
+        sorted(roles) if is_value(roles) else roles.__name__,
+        sorted(get_label(item) for item in agent)
+        if is_value(agent) else agent.__name__,
+        sorted(get_label(item) for item in target)
+        if is_value(target) else target.__name__,
+        get_generations(cache, names),
+    ))
+
+    return 'flexible_permissions:ids:%s' % md5(description).hexdigest()
+
+
+@receiver(permissions_changed)
+def bump_shared_generations(
+    sender,
+    roles,
+    agents,
+    targets,
+    target_models=None,
+    **kwargs
+):
+    cache = get_shared_cache()
+
+    if cache is None:
+        return
+
+    names = ['all']
+
+    if agents is ANY:
+        names.append('agent:any')
+    elif agents is NULL:
+        names.append('agent:null')
+    else:
+        agents = ensure_plural(agents)
+
+        if len(agents) > MAX_AGENT_GENERATIONS:
+            names.append('agent:any')
+        else:
+            names += ['agent:%s' % get_label(a) for a in agents]
+
+    if targets is ANY and target_models is not None:
+        names += ['target:%s' % get_model_label(t) for t in target_models]
+    elif targets is ANY:
+        names.append('target:any')
+    elif targets is not NULL:
+        names += [
+            'target:%s' % get_model_label(t.__class__)
+            for t in ensure_plural(targets)
+        ]
+
+    bump_generations(cache, sorted(set(names)))
+
+
+def bump_model_generations(models):
+    """
+    Invalidates shared entries for queries on any of models.
+    """
+    cache = get_shared_cache()
+
+    if cache is not None:
+        bump_generations(cache, [
+            'model:%s' % get_model_label(model) for model in models
+        ])
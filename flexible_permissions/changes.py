@@ -0,0 +1,60 @@
+from django.db.models import Max
+
+from itertools import islice
+
+from flexible_permissions.models import PermissionChange
+from flexible_permissions._utils import ITER_CHUNK_SIZE, iterate_keyset
+
+"""
+The change log. Every Permission the shortcuts add or remove is recorded
+in PermissionChange, so caches and replicas can catch up by reading the
+entries after the last seq they saw instead of the whole table.
+
+Sequence numbers are handed out when rows are written, not when their
+transaction commits, so an entry can become visible after ones with a
+higher seq. Readers that can't tolerate that should re-read a short
+window behind their last seq; applying an entry twice is harmless.
+"""
+
+ADD = PermissionChange.ADD
+REMOVE = PermissionChange.REMOVE
+
+ROW_FIELDS = (
+    'role',
+    'agent_type_id',
+    'agent_id',
+    'target_type_id',
+    'target_id',
+)
+
+
+def log_changes(op, rows):
+    """
+    Records rows of (role, agent type id, agent id, target type id,
+    target id) as added or removed.
+    """
+    PermissionChange.objects.bulk_create([
+        PermissionChange(op=op, **dict(zip(ROW_FIELDS, row)))
+        for row in rows
+    ])
+
+
+def get_last_seq():
+    """
+    Gets the seq of the latest change, or 0 if there are none. Read it
+    before loading Permissions to know where to sync from afterwards.
+    """
+    return PermissionChange.objects.aggregate(seq=Max('seq'))['seq'] or 0
+
+
+def changes_since(seq=0, limit=None, chunk_size=ITER_CHUNK_SIZE):
+    """
+    Yields the changes after seq in order, at most limit of them, loading
+    chunk_size at a time.
+    """
+    if limit is not None:
+        chunk_size = min(chunk_size, limit)
+
+    changes = PermissionChange.objects.filter(seq__gt=seq)
+
+    return islice(iterate_keyset(changes, chunk_size), limit)
@@ -0,0 +1,263 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from flexible_permissions.models import EffectivePermission
+from flexible_permissions.relations import (
+    get_compiled_paths,
+    get_path_models,
+    relation_receiver,
+)
+from flexible_permissions.roles import ROLES
+from flexible_permissions.signals import permissions_changed
+from flexible_permissions._utils import (
+    NULL,
+    chunked,
+    ensure_plural,
+    get_content_type_id,
+    get_model_name,
+    is_value,
+)
+
+"""
+Effective permissions. When FLEXIBLE_PERMISSIONS_EFFECTIVE is set, the
+EffectivePermission table holds one row per (action, agent, target) that a
+Permission grants, directly or through a registered relation, and
+for_action becomes a single lookup on it. Rows are kept in sync by the
+shortcuts and by saves and deletes of models along relation paths. Run the
+rebuild_effective_permissions command after enabling it, or after
+changing registered roles or relations.
+"""
+
+BATCH_SIZE = 1000
+
+
+def is_enabled():
+    return getattr(settings, 'FLEXIBLE_PERMISSIONS_EFFECTIVE', False)
+
+
+_target_models = []
+
+
+def get_target_models():
+    if not _target_models:
+        _target_models.extend(
+            model for model in apps.get_models()
+            if 'target_perms' in model._meta.get_all_field_names()
+        )
+
+    return _target_models
+
+
+def get_target_prefixes(model):
+    """
+    Returns (prefix, role prefix) pairs for every way a Permission can
+    reach a target of model. The role prefix is None for direct grants.
+    """
+    prefixes = [('target_perms', None)]
+
+    for role_prefix, paths in get_compiled_paths(model).items():
+        for path in paths:
+            prefixes.append((path + '__target_perms', role_prefix))
+
+    return prefixes
+
+
+"""
+Calculation
+"""
+
+
+def get_effective_perms(model, pks):
+    """
+    Calculates the EffectivePermissions for the targets of model with the
+    given pks, with one query per relation prefix.
+    """
+    content_type_id = get_content_type_id(model)
+    action_prefix = get_model_name(model) + '.'
+
+    rows = set()
+    for prefix, role_prefix in get_target_prefixes(model):
+        # Conditions on a multi-valued relation must share one filter call,
+        # or each gets its own join.
+        kwargs = {'pk__in': pks, prefix + '__role__isnull': False}
+
+        if role_prefix is not None:
+            kwargs[prefix + '__role__startswith'] = role_prefix + '.'
+
+        perms = model._default_manager.filter(**kwargs).values_list(
+            'pk',
+            prefix + '__role',
+            prefix + '__agent_type',
+            prefix + '__agent_id'
+        )
+
+        for pk, role, agent_type_id, agent_id in perms:
+            for action in ROLES.get(role, []):
+                if action.startswith(action_prefix):
+                    rows.add((action, agent_type_id, agent_id, pk))
+
+    return [
+        EffectivePermission(
+            action=action,
+            agent_type_id=agent_type_id,
+            agent_id=agent_id,
+            target_type_id=content_type_id,
+            target_id=pk
+        )
+        for action, agent_type_id, agent_id, pk in rows
+    ]
+
+
+def refresh(model, pks, batch_size=BATCH_SIZE):
+    """
+    Recalculates the EffectivePermissions of the given targets. pks may
+    be a values_list queryset, in which case it is streamed.
+    """
+    content_type_id = get_content_type_id(model)
+
+    with transaction.atomic():
+        for chunk in chunked(pks, batch_size):
+            EffectivePermission.objects.filter(
+                target_type_id=content_type_id,
+                target_id__in=chunk
+            ).delete()
+
+            EffectivePermission.objects.bulk_create(
+                get_effective_perms(model, chunk)
+            )
+
+
+def rebuild(batch_size=BATCH_SIZE):
+    """
+    Recalculates every EffectivePermission from scratch.
+    """
+    with transaction.atomic():
+        EffectivePermission.objects.all().delete()
+
+        for model in get_target_models():
+            pks = model._default_manager.order_by('pk')
+            refresh(model, pks.values_list('pk', flat=True), batch_size)
+
+
+"""
+Synchronization
+"""
+
+
+def get_dependents(model, pks):
+    """
+    Yields (target model, pks) for all targets whose effective permissions
+    depend on the objects of model with the given pks.
+    """
+    for target_model in get_target_models():
+        if issubclass(model, target_model):
+            yield target_model, pks
+
+        # Paths often share their first steps
+        subpaths = set()
+        for prefix, role_prefix in get_target_prefixes(target_model):
+            if role_prefix is None:
+                continue
+
+            path = prefix[:-len('__target_perms')]
+            for subpath, path_model in get_path_models(target_model, path):
+                if subpath in subpaths:
+                    continue
+
+                subpaths.add(subpath)
+                if issubclass(model, path_model):
+                    yield target_model, (
+                        target_model._default_manager
+                        .filter(**{subpath + '__in': pks})
+                        .values_list('pk', flat=True)
+                        .distinct()
+                    )
+
+
+def get_participating_models():
+    models = set()
+
+    for target_model in get_target_models():
+        models.add(target_model)
+
+        for prefix, role_prefix in get_target_prefixes(target_model):
+            if role_prefix is not None:
+                path = prefix[:-len('__target_perms')]
+                models.update(
+                    path_model for subpath, path_model
+                    in get_path_models(target_model, path)
+                )
+
+    return models
+
+
+@receiver(permissions_changed)
+def sync_permissions(
+    sender,
+    roles,
+    agents,
+    targets,
+    target_models=None,
+    **kwargs
+):
+    """
+    Refreshes the targets written to. When they weren't given as values,
+    every target of the models written to is refreshed, and only when
+    those aren't known either is everything rebuilt. Permissions without
+    a target grant no actions.
+    """
+    if not is_enabled() or targets is NULL:
+        return
+
+    pks_by_model = {}
+
+    if is_value(targets):
+        for target in ensure_plural(targets):
+            pks_by_model.setdefault(target.__class__, []).append(target.pk)
+    elif target_models is not None:
+        for model in target_models:
+            pks_by_model[model] = (
+                model._default_manager.order_by('pk')
+                .values_list('pk', flat=True)
+            )
+    else:
+        rebuild()
+        return
+
+    for model, pks in pks_by_model.items():
+        for target_model, target_pks in get_dependents(model, pks):
+            refresh(target_model, target_pks)
+
+
+@relation_receiver(post_save)
+def sync_saved(sender, instance, raw=False, **kwargs):
+    if raw or not is_enabled():
+        return
+
+    if sender in get_participating_models():
+        for target_model, pks in get_dependents(sender, [instance.pk]):
+            refresh(target_model, pks)
+
+
+def sync_deleted(sender, instance, **kwargs):
+    if not is_enabled():
+        return
+
+    if sender in get_target_models():
+        EffectivePermission.objects.filter(
+            target_type_id=get_content_type_id(sender),
+            target_id=instance.pk
+        ).delete()
+
+
+def connect_receivers():
+    """
+    Connects sync_deleted for target models only, which can't be deleted
+    in bulk anyway because of their target_perms relation. Called once
+    the app registry is ready.
+    """
+    for model in get_target_models():
+        post_delete.connect(sync_deleted, sender=model)
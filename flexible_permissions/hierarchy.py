@@ -0,0 +1,341 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from flexible_permissions.models import AgentClosure
+from flexible_permissions._utils import get_content_type_id
+
+import operator
+
+"""
+Agent hierarchies. Agents registered with a parent field get a row in
+AgentClosure for every ancestor, kept up to date as they are saved and
+deleted, so that all of an agent's ancestors can be found with a single
+indexed query however deep the hierarchy is.
+"""
+
+_parent_registry = {}
+
+
+def register_parent(cls, parent):
+    """
+    Declares that the parent field of cls points at another agent whose
+    authority instances of cls inherit.
+    """
+    _parent_registry[cls] = parent
+
+    # Only registered classes are listened to, so others keep fast deletes
+    pre_save.connect(check_saved, sender=cls)
+    post_save.connect(sync_saved, sender=cls)
+    post_delete.connect(sync_deleted, sender=cls)
+
+
+"""
+Nodes are (content type id, id) pairs
+"""
+
+
+def get_node(instance):
+    return (get_content_type_id(instance), instance.pk)
+
+
+def get_parent_node(instance):
+    field = instance._meta.get_field(_parent_registry[instance.__class__])
+    parent_id = getattr(instance, field.attname)
+
+    if parent_id is None:
+        return None
+
+    return (get_content_type_id(field.related_model), parent_id)
+
+
+def get_nodes_query(key, nodes):
+    ids_by_type = {}
+    for type_id, pk in nodes:
+        ids_by_type.setdefault(type_id, []).append(pk)
+
+    return reduce(operator.or_, [
+        Q(**{"%s_type_id" % key: type_id, "%s_id__in" % key: ids})
+        for type_id, ids in ids_by_type.items()
+    ], Q(id__isnull=True))
+
+
+def get_ancestors(agents):
+    """
+    Gets the ancestors of each of agents that belongs to a hierarchy, as a
+    dict of (model, pk) to a list of ancestors. Ancestors are instances
+    with only their pk set, which is all permission queries need.
+    """
+    agents = [
+        agent for agent in agents
+        if agent.__class__ in _parent_registry
+    ]
+
+    if not agents:
+        return {}
+
+    rows = AgentClosure.objects.filter(
+        get_nodes_query('descendant', [get_node(agent) for agent in agents]),
+        depth__gt=0
+    ).values_list(
+        'descendant_type_id',
+        'descendant_id',
+        'ancestor_type_id',
+        'ancestor_id'
+    )
+
+    result = {}
+    for row in rows:
+        descendant_type_id, descendant_id, ancestor_type_id, ancestor_id = row
+        descendant_model = ContentType.objects.get_for_id(descendant_type_id)
+        ancestor_model = ContentType.objects.get_for_id(ancestor_type_id)
+
+        key = (descendant_model.model_class(), descendant_id)
+        result.setdefault(key, []).append(
+            ancestor_model.model_class()(pk=ancestor_id)
+        )
+
+    return result
+
+
+def get_ancestor_models(cls):
+    """
+    Gets the models that agents above those of cls can be, following
+    registered parents.
+    """
+    models = []
+    while cls in _parent_registry:
+        cls = cls._meta.get_field(_parent_registry[cls]).related_model
+
+        if cls in models:
+            break
+
+        models.append(cls)
+
+    return models
+
+
+def get_descendant_ids(cls, get_ids):
+    """
+    Gets a subquery for the ids of agents of cls below any agent in
+    get_ids(model), a subquery for ids of agents of model. Returns None if
+    cls has no parents.
+    """
+    models = get_ancestor_models(cls)
+
+    if not models:
+        return None
+
+    return AgentClosure.objects.filter(
+        reduce(operator.or_, [
+            Q(
+                ancestor_type_id=get_content_type_id(model),
+                ancestor_id__in=get_ids(model)
+            )
+            for model in models
+        ]),
+        descendant_type_id=get_content_type_id(cls),
+        depth__gt=0
+    ).values('descendant_id')
+
+
+"""
+Maintenance
+"""
+
+
+def _create_rows(ancestors, descendants):
+    AgentClosure.objects.bulk_create([
+        AgentClosure(
+            ancestor_type_id=ancestor_type_id,
+            ancestor_id=ancestor_id,
+            descendant_type_id=descendant_type_id,
+            descendant_id=descendant_id,
+            depth=ancestor_depth + descendant_depth
+        )
+        for ancestor_type_id, ancestor_id, ancestor_depth in ancestors
+        for descendant_type_id, descendant_id, descendant_depth in descendants
+    ])
+
+
+def _get_rows(key, node, *fields):
+    return AgentClosure.objects.filter(**{
+        "%s_type_id" % key: node[0],
+        "%s_id" % key: node[1],
+    }).values_list(*fields)
+
+
+def validate_parent(instance):
+    """
+    Raises ValueError if instance's parent is instance itself or anything
+    below it.
+    """
+    node = get_node(instance)
+    parent = get_parent_node(instance)
+
+    if parent is None or instance.pk is None:
+        return
+
+    if parent == node or AgentClosure.objects.filter(
+        ancestor_type_id=node[0],
+        ancestor_id=node[1],
+        descendant_type_id=parent[0],
+        descendant_id=parent[1]
+    ).exists():
+        raise ValueError("%s can't be its own ancestor." % instance)
+
+
+def update_closure(instance):
+    """
+    Moves instance, along with everything below it, under its current
+    parent.
+    """
+    node = get_node(instance)
+    parent = get_parent_node(instance)
+
+    current_parent = _get_rows(
+        'descendant',
+        node,
+        'ancestor_type_id',
+        'ancestor_id'
+    ).filter(depth=1).first()
+
+    if current_parent == parent and _get_rows('descendant', node, 'id'):
+        return
+
+    with transaction.atomic():
+        subtree = list(_get_rows(
+            'ancestor',
+            node,
+            'descendant_type_id',
+            'descendant_id',
+            'depth'
+        ))
+
+        if not subtree:
+            subtree = [node + (0,)]
+            _create_rows([node + (0,)], subtree)
+
+        subtree_nodes = [(type_id, pk) for type_id, pk, depth in subtree]
+
+        if parent in subtree_nodes:
+            raise ValueError("%s can't be its own ancestor." % instance)
+
+        # Detach the subtree from its old ancestors
+        old_ancestors = _get_rows(
+            'descendant',
+            node,
+            'ancestor_type_id',
+            'ancestor_id'
+        ).filter(depth__gt=0)
+
+        if old_ancestors:
+            AgentClosure.objects.filter(
+                get_nodes_query('ancestor', old_ancestors),
+                get_nodes_query('descendant', subtree_nodes)
+            ).delete()
+
+        if parent is None:
+            return
+
+        # Attach it to the new ones, one level below the parent
+        ancestors = list(_get_rows(
+            'descendant',
+            parent,
+            'ancestor_type_id',
+            'ancestor_id',
+            'depth'
+        )) or [parent + (0,)]
+
+        _create_rows(
+            [(type_id, pk, depth + 1) for type_id, pk, depth in ancestors],
+            subtree
+        )
+
+
+def remove_closure(instance):
+    """
+    Removes instance, and detaches everything below it from its ancestors.
+    """
+    node = get_node(instance)
+
+    subtree_nodes = list(_get_rows(
+        'ancestor',
+        node,
+        'descendant_type_id',
+        'descendant_id'
+    ))
+    ancestors = list(_get_rows(
+        'descendant',
+        node,
+        'ancestor_type_id',
+        'ancestor_id'
+    ))
+
+    if subtree_nodes and ancestors:
+        AgentClosure.objects.filter(
+            get_nodes_query('ancestor', ancestors),
+            get_nodes_query('descendant', subtree_nodes)
+        ).delete()
+
+
+def rebuild_closure():
+    """
+    Recalculates AgentClosure from scratch, with one query per registered
+    class to load parents.
+    """
+    parents = {}
+    for cls, parent in _parent_registry.items():
+        type_id = get_content_type_id(cls)
+        field = cls._meta.get_field(parent)
+        parent_type_id = get_content_type_id(field.related_model)
+
+        for pk, parent_id in cls._default_manager.values_list('pk', parent):
+            parents[(type_id, pk)] = (
+                (parent_type_id, parent_id)
+                if parent_id is not None else
+                None
+            )
+
+    rows = []
+    for node in parents:
+        ancestor, depth = node, 0
+        while ancestor is not None:
+            rows.append(AgentClosure(
+                ancestor_type_id=ancestor[0],
+                ancestor_id=ancestor[1],
+                descendant_type_id=node[0],
+                descendant_id=node[1],
+                depth=depth
+            ))
+
+            ancestor, depth = parents.get(ancestor), depth + 1
+
+            if depth > len(parents):
+                raise ValueError("%s is its own ancestor." % (node,))
+
+    with transaction.atomic():
+        AgentClosure.objects.all().delete()
+        AgentClosure.objects.bulk_create(rows)
+
+
+"""
+Receivers, connected by register_parent
+"""
+
+
+def check_saved(sender, instance, raw=False, **kwargs):
+    # Before the row is written, so a cycle is never saved
+    if not raw and sender in _parent_registry:
+        validate_parent(instance)
+
+
+def sync_saved(sender, instance, raw=False, **kwargs):
+    if not raw and sender in _parent_registry:
+        update_closure(instance)
+
+
+def sync_deleted(sender, instance, **kwargs):
+    if sender in _parent_registry:
+        remove_closure(instance)
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import connection
+
+from flexible_permissions.signals import permission_timing
+
+logger = logging.getLogger('flexible_permissions')
+
+"""
+Instrumentation. Permission calls are timed and reported through the
+permission_timing signal, but only while something is connected to it.
+"""
+
+_local = threading.local()
+
+# Collectors running in any thread. _collect is only connected while
+# there are some, so permission calls are timed only then.
+_active = {'collectors': 0}
+_lock = threading.Lock()
+
+
+def _count_queries():
+    if not connection.queries_logged:
+        return None
+
+    return len(connection.queries_log)
+
+
+@contextmanager
+def instrument(phase, **details):
+    """
+    Times the block and sends permission_timing with the given details.
+    Code inside the block can add details with annotate.
+    """
+    if not permission_timing.receivers:
+        yield
+        return
+
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(details)
+
+    queries = _count_queries()
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        stack.pop()
+
+        if queries is not None:
+            queries = _count_queries() - queries
+
+        permission_timing.send(
+            sender=None,
+            phase=phase,
+            duration=duration,
+            queries=queries,
+            **details
+        )
+
+
+def instrumented(phase):
+    """
+    Decorator that instruments every call of the wrapped function.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            with instrument(phase):
+                return fn(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+def annotate(**details):
+    """
+    Adds details to the innermost instrumented call, if any.
+    """
+    stack = getattr(_local, 'stack', None)
+
+    if stack:
+        stack[-1].update(details)
+
+
+"""
+Collection
+"""
+
+COLLECT_UID = 'flexible_permissions.instrumentation'
+
+
+class PermissionTimingCollector(object):
+    """
+    Aggregates permission_timing per phase for the current thread, and
+    keeps the slowest calls. If count_queries is set, queries are logged
+    while collecting so that they can be counted even without DEBUG.
+    """
+    def __init__(self, slowest=10, count_queries=True):
+        self.slowest = slowest
+        self.count_queries = count_queries
+        self.phases = {}
+        self.calls = []
+
+    def start(self):
+        with _lock:
+            _active['collectors'] += 1
+            permission_timing.connect(_collect, dispatch_uid=COLLECT_UID)
+
+        self._previous = getattr(_local, 'collector', None)
+        _local.collector = self
+
+        if self.count_queries:
+            self._force_debug_cursor = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+
+    def stop(self):
+        _local.collector = self._previous
+
+        if self.count_queries:
+            connection.force_debug_cursor = self._force_debug_cursor
+
+        with _lock:
+            _active['collectors'] -= 1
+
+            if not _active['collectors']:
+                permission_timing.disconnect(dispatch_uid=COLLECT_UID)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add(self, call):
+        phase = self.phases.setdefault(call['phase'], {
+            'calls': 0,
+            'duration': 0,
+            'queries': 0,
+        })
+
+        phase['calls'] += 1
+        phase['duration'] += call['duration']
+        phase['queries'] += call['queries'] or 0
+
+        self.calls.append(call)
+        self.calls.sort(key=lambda call: call['duration'], reverse=True)
+        del self.calls[self.slowest:]
+
+    def log(self, level=logging.INFO):
+        for name, phase in sorted(self.phases.items()):
+            logger.log(
+                level,
+                "%s: %s calls, %.2fms, %s queries",
+                name,
+                phase['calls'],
+                phase['duration'] * 1000,
+                phase['queries']
+            )
+
+        for call in self.calls:
+            logger.log(level, "Slow call: %r", call)
+
+
+def _collect(sender, **call):
+    collector = getattr(_local, 'collector', None)
+
+    if collector is not None:
+        call.pop('signal', None)
+        collector.add(call)
+
+
+class PermissionTimingMiddleware(object):
+    """
+    Collects permission timings for each request and logs them.
+    """
+    def process_request(self, request):
+        request._permission_timing = PermissionTimingCollector()
+        request._permission_timing.start()
+
+    def process_response(self, request, response):
+        collector = getattr(request, '_permission_timing', None)
+
+        if collector is not None:
+            collector.stop()
+            collector.log()
+
+        return response
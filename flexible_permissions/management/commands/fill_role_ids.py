@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from flexible_permissions.models import Permission
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills in missing or stale Permission role ids. Run this before "
+        "turning on FLEXIBLE_PERMISSIONS_ROLE_IDS."
+    )
+
+    def handle(self, *args, **options):
+        count = Permission.objects.fill_role_ids()
+        self.stdout.write("Updated %s permissions." % count)
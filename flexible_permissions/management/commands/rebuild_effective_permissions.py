@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from flexible_permissions.effective import BATCH_SIZE, rebuild
+
+
+class Command(BaseCommand):
+    help = "Recalculates the EffectivePermission table from scratch."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help="Number of targets to recalculate at a time."
+        )
+
+    def handle(self, *args, **options):
+        rebuild(options['batch_size'])
@@ -0,0 +1,445 @@
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+
+import operator
+
+from itertools import islice
+
+from flexible_permissions.agents import normalize_agent
+from flexible_permissions.changes import changes_since, get_last_seq
+from flexible_permissions.models import Permission
+from flexible_permissions.relations import (
+    get_compiled_paths,
+    get_path_models,
+    get_relation_senders,
+    is_multi_valued,
+)
+from flexible_permissions.roles import actions_to_roles
+from flexible_permissions.signals import permissions_changed
+from flexible_permissions._utils import (
+    ANY,
+    IN_CHUNK_SIZE,
+    NULL,
+    chunked,
+    ensure_plural,
+    get_content_type_id,
+    get_model_name,
+    get_multi_crud_query,
+    is_value,
+    normalize_value,
+    validate_roles_with_targets,
+)
+
+"""
+In-memory evaluation. For small sets of permissions, such as a single
+tenant's, a MemoryEngine loads the Permission rows once and answers checks
+from Python dicts and sets without touching the database. Relation edges
+are loaded per relation path the first time a check needs them.
+
+Agents and targets are indexed as (content type id, id) pairs, with
+(None, None) standing for public grants.
+"""
+
+PUBLIC = (None, None)
+
+# Changes can become visible after ones with a higher seq, so sync reads
+# this many seqs back from the last one it saw
+SYNC_WINDOW = 1000
+
+
+def _get_pairs(values):
+    return set(
+        (get_content_type_id(value), value.pk)
+        for value in ensure_plural(values)
+    )
+
+
+def _matches(value, allowed):
+    if allowed is ANY:
+        return True
+
+    if allowed is NULL:
+        return value is None or value == PUBLIC
+
+    return value in allowed
+
+
+class MemoryEngine(object):
+    def __init__(self, permissions=None, querysets=None):
+        """
+        permissions is the queryset of Permissions to load, all of them by
+        default. querysets optionally maps models to the querysets relation
+        edges are loaded from, to keep them to the same tenant.
+
+        The engine follows permissions_changed, saves and deletes until it
+        is closed. Changes made by other processes are applied by sync.
+        """
+        if permissions is None:
+            permissions = Permission.objects.all()
+
+        self._permissions = permissions
+        self._querysets = querysets or {}
+
+        self._rows = set()
+
+        # {agent: {(target type id, role): set(target ids)}}
+        self._grants = {}
+
+        # {target: {role: set(agents)}}
+        self._holders = {}
+
+        # {(model, path): {pk: set(related pks)}} and its reverse
+        self._edges = {}
+        self._reverse_edges = {}
+
+        self._seq = get_last_seq()
+        self._seen = set(
+            change.seq for change in changes_since(self._seq - SYNC_WINDOW)
+        )
+        self._load(permissions)
+
+        # Only relation models can change edges
+        self._senders = get_relation_senders()
+
+        permissions_changed.connect(self._sync_permissions)
+        for sender in self._senders:
+            post_save.connect(self._sync_edges, sender=sender)
+            post_delete.connect(self._sync_edges, sender=sender)
+
+    def close(self):
+        permissions_changed.disconnect(self._sync_permissions)
+        for sender in self._senders:
+            post_save.disconnect(self._sync_edges, sender=sender)
+            post_delete.disconnect(self._sync_edges, sender=sender)
+
+    """
+    Loading
+    """
+
+    def _load(self, permissions):
+        rows = permissions.values_list(
+            'role',
+            'agent_type_id',
+            'agent_id',
+            'target_type_id',
+            'target_id'
+        )
+
+        for role, agent_type_id, agent_id, target_type_id, target_id in rows:
+            self._add((role, (agent_type_id, agent_id), (
+                target_type_id,
+                target_id
+            )))
+
+    def _add(self, row):
+        role, agent, target = row
+        self._rows.add(row)
+
+        grants = self._grants.setdefault(agent, {})
+        grants.setdefault((target[0], role), set()).add(target[1])
+
+        holders = self._holders.setdefault(target, {})
+        holders.setdefault(role, set()).add(agent)
+
+    def _discard(self, row):
+        role, agent, target = row
+        self._rows.discard(row)
+
+        self._grants[agent][(target[0], role)].discard(target[1])
+        self._holders[target][role].discard(agent)
+
+    def _get_queryset(self, model):
+        return self._querysets.get(model, model._default_manager.all())
+
+    def _load_edges(self, model, path):
+        key = (model, path)
+
+        if key not in self._edges:
+            rows = (
+                self._get_queryset(model)
+                .filter(**{path + '__isnull': False})
+                .values_list('pk', path)
+            )
+
+            # Multi-valued paths give a row per related object
+            edges, reverse_edges = {}, {}
+            for pk, related_pk in rows:
+                edges.setdefault(pk, set()).add(related_pk)
+                reverse_edges.setdefault(related_pk, set()).add(pk)
+
+            self._edges[key] = edges
+            self._reverse_edges[key] = reverse_edges
+
+        return self._edges[key], self._reverse_edges[key]
+
+    """
+    Synchronization
+    """
+
+    def _sync_permissions(self, sender, roles, agents, targets, **kwargs):
+        """
+        Replaces every row matching the change with what's now in the
+        database.
+        """
+        role_set = set(ensure_plural(roles)) if is_value(roles) else roles
+        agent_pairs = _get_pairs(agents) if is_value(agents) else agents
+        target_pairs = _get_pairs(targets) if is_value(targets) else targets
+
+        for row in list(self._rows):
+            role, agent, target = row
+            if (
+                _matches(role, role_set) and
+                _matches(agent, agent_pairs) and
+                _matches(target, target_pairs)
+            ):
+                self._discard(row)
+
+        self._load(self._permissions.filter(
+            get_multi_crud_query(roles, agents, targets)
+        ))
+
+    def sync(self, limit=None):
+        """
+        Applies the changes logged since the engine was loaded or last
+        synced, at most limit of them. Returns how many were applied.
+
+        Changes committed late, behind ones already applied, are picked up
+        as long as they're within SYNC_WINDOW seqs of the latest.
+        """
+        changes = list(islice(
+            (
+                change for change in changes_since(self._seq - SYNC_WINDOW)
+                if change.seq not in self._seen
+            ),
+            limit
+        ))
+
+        if not changes:
+            return 0
+
+        rows = set(
+            (
+                change.role,
+                (change.agent_type_id, change.agent_id),
+                (change.target_type_id, change.target_id)
+            )
+            for change in changes
+        )
+
+        # Replace each row with whatever is now in the database, so the
+        # order changes are applied in doesn't matter
+        for row in rows & self._rows:
+            self._discard(row)
+
+        for chunk in chunked(list(rows), IN_CHUNK_SIZE):
+            self._load(self._permissions.filter(reduce(operator.or_, [
+                Q(
+                    role=role,
+                    agent_type_id=agent[0],
+                    agent_id=agent[1],
+                    target_type_id=target[0],
+                    target_id=target[1]
+                )
+                for role, agent, target in chunk
+            ])))
+
+        self._seen.update(change.seq for change in changes)
+        self._seq = max(self._seen)
+        self._seen = set(
+            seq for seq in self._seen if seq > self._seq - SYNC_WINDOW
+        )
+
+        return len(changes)
+
+    def _get_edge_models(self, model, path):
+        """
+        Gets the models along path whose rows hold its links. The last
+        model's rows only do when the path is multi-valued.
+        """
+        path_models = [
+            path_model for subpath, path_model in get_path_models(model, path)
+        ]
+
+        if is_multi_valued(model, path):
+            return path_models
+
+        return path_models[:-1]
+
+    def _sync_edges(self, sender, instance, **kwargs):
+        """
+        Reloads the edges of a saved or deleted object, and forgets any
+        that pass through it.
+        """
+        for model, path in list(self._edges):
+            if isinstance(instance, model):
+                edges = self._edges[(model, path)]
+                reverse_edges = self._reverse_edges[(model, path)]
+
+                for related_pk in edges.pop(instance.pk, ()):
+                    reverse_edges[related_pk].discard(instance.pk)
+
+                related_pks = set(
+                    self._get_queryset(model)
+                    .filter(pk=instance.pk, **{path + '__isnull': False})
+                    .values_list(path, flat=True)
+                )
+
+                if related_pks:
+                    edges[instance.pk] = related_pks
+
+                for related_pk in related_pks:
+                    reverse_edges.setdefault(related_pk, set()).add(
+                        instance.pk
+                    )
+            elif [
+                path_model
+                for path_model in self._get_edge_models(model, path)
+                if isinstance(instance, path_model)
+            ]:
+                del self._edges[(model, path)]
+                del self._reverse_edges[(model, path)]
+
+    """
+    Evaluation
+    """
+
+    def _get_agents(self, agent, infer_agents):
+        agent = normalize_value(
+            agent,
+            normalize_agent,
+            infer_agents=infer_agents
+        )
+
+        if agent is ANY:
+            return self._grants.keys()
+
+        if agent is NULL:
+            return [PUBLIC]
+
+        return _get_pairs(agent) | set([PUBLIC])
+
+    def _get_action_roles(self, model, action):
+        if "." in action:
+            raise ValueError(
+                "Prefixes are inferred. Register this with its own actions."
+            )
+
+        return actions_to_roles("%s.%s" % (get_model_name(model), action))
+
+    def _get_paths(self, model):
+        for role_prefix, paths in get_compiled_paths(model).items():
+            for path in paths:
+                subpath, path_model = get_path_models(model, path)[-1]
+                yield role_prefix, path, get_content_type_id(path_model)
+
+    def for_role(self, model, roles, agent=ANY, infer_agents=True):
+        """
+        Like for_role on the queryset, but returns a set of pks.
+        """
+        agents = self._get_agents(agent, infer_agents)
+        content_type_id = get_content_type_id(model)
+
+        result = set()
+        for agent in agents:
+            for (type_id, role), pks in self._grants.get(agent, {}).items():
+                if type_id == content_type_id and _matches(role, roles):
+                    result.update(pks)
+
+        # Like the queryset, only direct grants count for any role
+        if not is_value(roles):
+            return result
+
+        for role_prefix, path, path_type_id in self._get_paths(model):
+            path_roles = [
+                role for role in roles if role.startswith(role_prefix + '.')
+            ]
+
+            if not path_roles:
+                continue
+
+            edges, reverse_edges = self._load_edges(model, path)
+            for agent in agents:
+                grants = self._grants.get(agent, {})
+
+                for role in path_roles:
+                    for related_pk in grants.get((path_type_id, role), ()):
+                        result.update(reverse_edges.get(related_pk, ()))
+
+        return result
+
+    def for_action(self, model, action, agent=ANY, infer_agents=True):
+        """
+        Like for_action on the queryset, but returns a set of pks.
+        """
+        roles = self._get_action_roles(model, action)
+        return self.for_role(model, roles, agent, infer_agents)
+
+    def has_perm(self, agent, action, obj, infer_agents=True):
+        """
+        Like shortcuts.has_perm.
+        """
+        model = obj.__class__
+        roles = self._get_action_roles(model, action)
+        agents = set(self._get_agents(agent, infer_agents))
+
+        candidates = [((get_content_type_id(model), obj.pk), None)]
+        for role_prefix, path, path_type_id in self._get_paths(model):
+            edges, reverse_edges = self._load_edges(model, path)
+
+            for related_pk in edges.get(obj.pk, ()):
+                candidates.append(((path_type_id, related_pk), role_prefix))
+
+        for target, role_prefix in candidates:
+            holders = self._holders.get(target, {})
+
+            for role in roles:
+                if role_prefix is not None and (
+                    not role.startswith(role_prefix + '.')
+                ):
+                    continue
+
+                if holders.get(role, set()) & agents:
+                    return True
+
+        return False
+
+    def with_role(self, model, roles=ANY, target=ANY):
+        """
+        Finds the pks of agents of model holding roles on target directly.
+        Unlike with_role on the queryset, grants on objects target is
+        related to, and agents inheriting a grant through their paths or
+        a parent, aren't included.
+        """
+        validate_roles_with_targets(roles, target)
+
+        if is_value(roles):
+            roles = set(ensure_plural(roles))
+
+        content_type_id = get_content_type_id(model)
+        targets = (
+            _get_pairs(target)
+            if is_value(target) else
+            self._holders.keys()
+        )
+
+        result = set()
+        for target in targets:
+            for role, agents in self._holders.get(target, {}).items():
+                if _matches(role, roles):
+                    result.update(
+                        agent_id for agent_type_id, agent_id in agents
+                        if agent_type_id == content_type_id
+                    )
+
+        return result
+
+    def with_action(self, model, actions=ANY, target=ANY):
+        if is_value(actions):
+            actions = ensure_plural(actions)
+
+            if [action for action in actions if "." not in action]:
+                raise ValueError(
+                    "Prefixes are required since target is optional."
+                )
+
+        return self.with_role(model, actions_to_roles(actions), target)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Public permissions are ORed into every agent query
+PUBLIC_INDEX_VENDORS = ['postgresql', 'sqlite']
+PUBLIC_INDEX_NAME = 'flexible_permissions_permission_public'
+
+
+def create_public_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in PUBLIC_INDEX_VENDORS:
+        return
+
+    schema_editor.execute(
+        'CREATE INDEX %s ON flexible_permissions_permission '
+        '(target_type_id, target_id, role) WHERE agent_id IS NULL'
+        % PUBLIC_INDEX_NAME
+    )
+
+
+def drop_public_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in PUBLIC_INDEX_VENDORS:
+        return
+
+    schema_editor.execute('DROP INDEX %s' % PUBLIC_INDEX_NAME)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flexible_permissions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='permission',
+            index_together=set([('target_type', 'target_id', 'role'), ('agent_type', 'agent_id', 'role')]),
+        ),
+        migrations.RunPython(create_public_index, drop_public_index),
+    ]
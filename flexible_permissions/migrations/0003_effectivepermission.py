@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('flexible_permissions', '0002_permission_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectivePermission',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('action', models.CharField(max_length=255)),
+                ('agent_id', models.PositiveIntegerField(null=True, blank=True)),
+                ('target_id', models.PositiveIntegerField()),
+                ('agent_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, blank=True, to='contenttypes.ContentType', null=True)),
+                ('target_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='effectivepermission',
+            unique_together=set([('target_type', 'action', 'agent_type', 'agent_id', 'target_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='effectivepermission',
+            index_together=set([('target_type', 'target_id')]),
+        ),
+    ]
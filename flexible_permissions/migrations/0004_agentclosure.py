@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('flexible_permissions', '0003_effectivepermission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgentClosure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('ancestor_id', models.PositiveIntegerField()),
+                ('descendant_id', models.PositiveIntegerField()),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, to='contenttypes.ContentType')),
+                ('descendant_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='agentclosure',
+            unique_together=set([('descendant_type', 'descendant_id', 'ancestor_type', 'ancestor_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='agentclosure',
+            index_together=set([('ancestor_type', 'ancestor_id')]),
+        ),
+    ]
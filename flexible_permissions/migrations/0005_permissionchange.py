@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('flexible_permissions', '0004_agentclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PermissionChange',
+            fields=[
+                ('seq', models.AutoField(serialize=False, primary_key=True)),
+                ('op', models.CharField(max_length=6, choices=[(b'add', b'Add'), (b'remove', b'Remove')])),
+                ('role', models.CharField(max_length=255)),
+                ('agent_id', models.PositiveIntegerField(null=True, blank=True)),
+                ('target_id', models.PositiveIntegerField()),
+                ('agent_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, blank=True, to='contenttypes.ContentType', null=True)),
+                ('target_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, to='contenttypes.ContentType')),
+            ],
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import zlib
+
+# SQLite rebuilds the table to add a column, which loses the partial index
+# created in 0002, so it's dropped first and created again at the end
+PUBLIC_INDEX_VENDORS = ['postgresql', 'sqlite']
+PUBLIC_INDEX_NAME = 'flexible_permissions_permission_public'
+
+
+def create_public_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in PUBLIC_INDEX_VENDORS:
+        return
+
+    schema_editor.execute(
+        'CREATE INDEX %s ON flexible_permissions_permission '
+        '(target_type_id, target_id, role) WHERE agent_id IS NULL'
+        % PUBLIC_INDEX_NAME
+    )
+
+
+def drop_public_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in PUBLIC_INDEX_VENDORS:
+        return
+
+    schema_editor.execute('DROP INDEX IF EXISTS %s' % PUBLIC_INDEX_NAME)
+
+
+def get_role_id(role):
+    # A copy of _utils.get_role_id as it was, so this migration can't change
+    return zlib.crc32(role.encode('utf-8')) & 0x7fffffff
+
+
+def backfill_role_ids(apps, schema_editor):
+    Permission = apps.get_model('flexible_permissions', 'Permission')
+
+    # One UPDATE per distinct role
+    roles = Permission.objects.order_by().values_list('role', flat=True)
+    for role in roles.distinct():
+        Permission.objects.filter(role=role).update(role_id=get_role_id(role))
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flexible_permissions', '0005_permissionchange'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_public_index, create_public_index),
+        migrations.AddField(
+            model_name='permission',
+            name='role_id',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.RunPython(backfill_role_ids, noop),
+        migrations.AlterIndexTogether(
+            name='permission',
+            index_together=set([('agent_type', 'agent_id', 'role_id'), ('target_type', 'target_id', 'role'), ('target_type', 'target_id', 'role_id'), ('agent_type', 'agent_id', 'role')]),
+        ),
+        migrations.RunPython(create_public_index, drop_public_index),
+    ]
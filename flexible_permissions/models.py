@@ -2,10 +2,58 @@ from django.db import models
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
+from flexible_permissions._utils import get_role_id
+
+
+class PermissionQuerySet(models.QuerySet):
+    """
+    Keeps role_id in step with role for writes that skip Permission.save.
+    """
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            if obj.role is not None:
+                obj.role_id = get_role_id(obj.role)
+
+        return super(PermissionQuerySet, self).bulk_create(
+            objs, *args, **kwargs
+        )
+
+    def update(self, **kwargs):
+        if 'role' in kwargs and 'role_id' not in kwargs:
+            role = kwargs['role']
+            if not isinstance(role, basestring):
+                raise ValueError(
+                    "role_id must be given when updating role to %r" % role
+                )
+
+            kwargs['role_id'] = get_role_id(role)
+
+        return super(PermissionQuerySet, self).update(**kwargs)
+
+    def fill_role_ids(self):
+        """
+        Sets role_id wherever it is missing or doesn't match role, with one
+        UPDATE per role. Returns how many rows changed.
+        """
+        roles = self.order_by().values_list('role', flat=True).distinct()
+
+        count = 0
+        for role in list(roles):
+            role_id = get_role_id(role)
+            count += self.filter(role=role).exclude(role_id=role_id).update(
+                role_id=role_id
+            )
+
+        return count
+
 
 class Permission(models.Model):
     role = models.CharField(max_length=255)
 
+    # Filled in from role on save; see _utils.get_role_id
+    role_id = models.IntegerField(null=True, blank=True)
+
     agent_type = models.ForeignKey(
         ContentType,
         related_name='+',
@@ -24,6 +72,8 @@ class Permission(models.Model):
     target_id = models.PositiveIntegerField()
     target = GenericForeignKey('target_type', 'target_id')
 
+    objects = PermissionQuerySet.as_manager()
+
     class Meta:
         unique_together = [
             'role',
@@ -33,5 +83,135 @@ class Permission(models.Model):
             'target_id'
         ]
 
+        # Ordered for joining from targets and agents respectively
+        index_together = [
+            ('target_type', 'target_id', 'role'),
+            ('agent_type', 'agent_id', 'role'),
+            ('target_type', 'target_id', 'role_id'),
+            ('agent_type', 'agent_id', 'role_id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.role is not None:
+            self.role_id = get_role_id(self.role)
+
+        super(Permission, self).save(*args, **kwargs)
+
+    def __unicode__(self):
+        return "%s %s" % (self.__class__.__name__, self.pk)
+
+
+class EffectivePermission(models.Model):
+    """
+    A denormalized copy of which actions each agent may take on each target,
+    including those inherited through registered relations. This is only
+    maintained when FLEXIBLE_PERMISSIONS_EFFECTIVE is set.
+    """
+    action = models.CharField(max_length=255)
+
+    agent_type = models.ForeignKey(
+        ContentType,
+        related_name='+',
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True
+    )
+    agent_id = models.PositiveIntegerField(null=True, blank=True)
+
+    target_type = models.ForeignKey(
+        ContentType,
+        related_name='+',
+        on_delete=models.PROTECT
+    )
+    target_id = models.PositiveIntegerField()
+
+    class Meta:
+        # Ordered for looking up targets by action and agent
+        unique_together = [
+            'target_type',
+            'action',
+            'agent_type',
+            'agent_id',
+            'target_id'
+        ]
+
+        index_together = [
+            ('target_type', 'target_id'),
+        ]
+
+    def __unicode__(self):
+        return "%s %s" % (self.__class__.__name__, self.pk)
+
+
+class AgentClosure(models.Model):
+    """
+    Every (ancestor, descendant) pair of agents registered with a parent,
+    including each agent paired with itself at depth 0.
+    """
+    ancestor_type = models.ForeignKey(
+        ContentType,
+        related_name='+',
+        on_delete=models.PROTECT
+    )
+    ancestor_id = models.PositiveIntegerField()
+
+    descendant_type = models.ForeignKey(
+        ContentType,
+        related_name='+',
+        on_delete=models.PROTECT
+    )
+    descendant_id = models.PositiveIntegerField()
+
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        # Ordered for looking up ancestors
+        unique_together = [
+            'descendant_type',
+            'descendant_id',
+            'ancestor_type',
+            'ancestor_id'
+        ]
+
+        index_together = [
+            ('ancestor_type', 'ancestor_id'),
+        ]
+
+    def __unicode__(self):
+        return "%s %s" % (self.__class__.__name__, self.pk)
+
+
+class PermissionChange(models.Model):
+    """
+    An append-only log of Permission rows added and removed, in the order
+    they were written.
+    """
+    ADD = 'add'
+    REMOVE = 'remove'
+
+    seq = models.AutoField(primary_key=True)
+    op = models.CharField(
+        max_length=6,
+        choices=[(ADD, 'Add'), (REMOVE, 'Remove')]
+    )
+
+    role = models.CharField(max_length=255)
+
+    agent_type = models.ForeignKey(
+        ContentType,
+        related_name='+',
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True
+    )
+    agent_id = models.PositiveIntegerField(null=True, blank=True)
+
+    target_type = models.ForeignKey(
+        ContentType,
+        related_name='+',
+        on_delete=models.PROTECT
+    )
+    target_id = models.PositiveIntegerField()
+
     def __unicode__(self):
         return "%s %s" % (self.__class__.__name__, self.pk)
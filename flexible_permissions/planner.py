@@ -0,0 +1,142 @@
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from flexible_permissions.models import Permission
+from flexible_permissions.relations import get_path_models
+from flexible_permissions._utils import (
+    ANY,
+    generic_in,
+    get_content_type_id,
+    is_value,
+)
+
+"""
+Strategies for combining the queries for each related prefix. EFFECTIVE
+is never chosen here; it marks lookups answered from the materialized
+EffectivePermission table instead.
+"""
+TOGETHER = 'together'
+SEPARATE = 'separate'
+UNION = 'union'
+SUBQUERY = 'subquery'
+EFFECTIVE = 'effective'
+AUTO = 'auto'
+
+
+"""
+Adaptive planning. Given AUTO, or any unspecified strategy when
+FLEXIBLE_PERMISSIONS_PLANNER is set, one is picked from rough cardinality
+estimates: how many permissions involve each kind of object a query joins
+through, and how many the agents asked about hold. Estimates are plain
+counts, kept per process and refreshed every
+FLEXIBLE_PERMISSIONS_STATS_TIMEOUT seconds.
+"""
+
+# Fetching ids first is only worth it when few grants can match
+SEPARATE_LIMIT = 100
+
+# Agents holding less than this share of the rows drive a semi-join
+SELECTIVE_RATIO = 100
+
+# Forget everything rather than grow without bound
+MAX_STATS = 10000
+
+_stats = {}
+
+
+def is_adaptive():
+    return getattr(settings, 'FLEXIBLE_PERMISSIONS_PLANNER', False)
+
+
+def get_stats_timeout():
+    return getattr(settings, 'FLEXIBLE_PERMISSIONS_STATS_TIMEOUT', 300)
+
+
+def clear_stats():
+    _stats.clear()
+
+
+def _get_count(key, queryset):
+    now = time.time()
+    entry = _stats.get(key)
+
+    if entry is None or entry[1] <= now:
+        if len(_stats) >= MAX_STATS:
+            _stats.clear()
+
+        entry = (queryset.count(), now + get_stats_timeout())
+        _stats[key] = entry
+
+    return entry[0]
+
+
+def get_type_count(side, model):
+    """
+    Counts the permissions whose agent or target, as side says, is of
+    model.
+    """
+    type_id = get_content_type_id(model)
+
+    return _get_count(
+        (side, type_id),
+        Permission.objects.filter(**{side + '_type_id': type_id})
+    )
+
+
+def get_agent_count(agents):
+    """
+    Counts the permissions held by agents, public ones included.
+    """
+    key = ('agents', frozenset(
+        (get_content_type_id(agent), agent.pk) for agent in agents
+    ))
+
+    return _get_count(key, Permission.objects.filter(
+        Q(agent_id__isnull=True) | generic_in('agent', agents)
+    ))
+
+
+def get_estimates(model, perms_name, prefixes, agent=ANY):
+    """
+    Estimates the rows each prefix's query looks through, and the rows
+    agent holds if one was given.
+    """
+    side = 'target' if perms_name == 'target_perms' else 'agent'
+
+    estimates = {}
+    for prefix in prefixes:
+        path = prefix[:-len(perms_name)].rstrip('_')
+        related_model = get_path_models(model, path)[-1][1] if path else model
+
+        estimates[prefix] = get_type_count(side, related_model)
+
+    if is_value(agent):
+        estimates['agents'] = get_agent_count(agent)
+
+    return estimates
+
+
+def choose_strategy(model, perms_name, prefixes, agent=ANY):
+    """
+    Picks a strategy for querying model through prefixes. Returns it with
+    the estimates it was based on.
+    """
+    if len(prefixes) <= 1 and perms_name in prefixes:
+        # A single direct join needs no estimates
+        return TOGETHER, {}
+
+    estimates = get_estimates(model, perms_name, prefixes, agent)
+
+    rows = sum(estimates[prefix] for prefix in prefixes)
+    matches = min(rows, estimates.get('agents', rows))
+
+    if matches <= SEPARATE_LIMIT:
+        strategy = SEPARATE
+    elif matches * SELECTIVE_RATIO < rows:
+        strategy = SUBQUERY
+    else:
+        strategy = UNION
+
+    return strategy, estimates
@@ -1,27 +1,75 @@
+from django.db import connections
 from django.db.models import Q, QuerySet
 
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
 from itertools import chain
 
-from flexible_permissions.agents import normalize_agent
+import operator
+
+from flexible_permissions import effective
+from flexible_permissions.agents import get_agent_paths, normalize_agent
+from flexible_permissions.cache import (
+    TOO_MANY_IDS,
+    CachedTargets,
+    get_request_cache,
+    get_shared_cache,
+    get_shared_key,
+    get_shared_max_ids,
+    get_shared_timeout,
+    get_targets_key,
+)
+from flexible_permissions.hierarchy import get_descendant_ids
 from flexible_permissions.relations import (
+    get_compiled_paths,
+    get_path_models,
+    get_relation_models,
     get_related_target_prefixes,
     get_related_agent_prefixes,
 )
+from flexible_permissions.instrumentation import annotate, instrumented
+from flexible_permissions.models import EffectivePermission, Permission
+from flexible_permissions.planner import (
+    AUTO,
+    EFFECTIVE,
+    SEPARATE,
+    SUBQUERY,
+    TOGETHER,
+    UNION,
+    choose_strategy,
+    is_adaptive,
+)
 from flexible_permissions.roles import actions_to_roles
+from flexible_permissions.shortcuts import (
+    _get_candidates,
+    _get_grant_query,
+    get_allowed_actions,
+)
 from flexible_permissions._utils import (
     ANY,
+    ITER_CHUNK_SIZE,
     NULL,
     ensure_plural,
     generic_in,
+    get_content_type_id,
     get_key,
+    get_roles_query,
     filter_isnull,
     is_value,
+    iterate_keyset,
     normalize_value,
     get_model_name,
     validate_roles_with_targets,
 )
 
 
+def get_strategy(strategy, force_separate):
+    return SEPARATE if force_separate else strategy
+
+
 def define_filter(key):
     def decorator(fn):
         def wrapped(queryset, value=ANY, prefix=None):
@@ -40,17 +88,41 @@ def define_filter(key):
 
 
 class PermQuerySet(QuerySet):
+    _plan = None
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_plan', self._plan)
+
+        return super(PermQuerySet, self)._clone(*args, **kwargs)
+
+    def explain_plan(self):
+        """
+        Describes how the permission query behind this queryset was run:
+        the strategy, the related prefixes, any estimates the planner
+        used, whether ids came from a cache, and the resulting SQL. If
+        nothing can match, empty is set and there is no SQL.
+        """
+        try:
+            sql, params = self.query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            sql, params = None, ()
+
+        plan = {'strategy': None}
+        plan.update(self._plan or {})
+        plan.update(sql=sql, params=params, empty=sql is None)
+
+        return plan
 
     """
     Query Building stuff
     """
 
     def _get_filter(self, key, value):
-        return generic_in(key, ensure_plural(value))
+        return generic_in(key, value)
 
     @define_filter('role')
     def _get_role_query(self, role, prefix):
-        return Q(**{get_key('role', prefix, 'in'): role})
+        return get_roles_query(role, prefix)
 
     @define_filter('agent')
     def _get_agent_query(self, agent, prefix):
@@ -101,6 +173,43 @@ class PermQuerySet(QuerySet):
         # Keep the ordering here since this is the result
         return self.filter(id__in=set(chain(*ids)))
 
+    def _query_union(self, queries):
+        """
+        This combines the queries as a single UNION subquery, so the
+        database does the deduplication and no ids come back to Python.
+        """
+        connection = connections[self.db]
+        queryset = self.__class__(model=self.model, using=self._db)
+
+        sqls, params = [], []
+        for query in queries:
+            # UNIONed selects can't be ordered
+            subquery = queryset.filter(query).order_by().values('pk').query
+            sql, query_params = subquery.get_compiler(self.db).as_sql()
+
+            sqls.append(sql)
+            params.extend(query_params)
+
+        where = '%s.%s IN (%s)' % (
+            connection.ops.quote_name(self.model._meta.db_table),
+            connection.ops.quote_name(self.model._meta.pk.column),
+            ' UNION '.join(sqls)
+        )
+
+        return self.extra(where=[where], params=params)
+
+    def _query_subquery(self, queries):
+        """
+        This ORs an IN subquery per query together, which most databases
+        run as a semi-join per prefix.
+        """
+        queryset = self.__class__(model=self.model, using=self._db)
+
+        return self.filter(reduce(operator.or_, [
+            Q(pk__in=queryset.filter(query).order_by().values('pk'))
+            for query in queries
+        ]))
+
     def _query_together(self, queries):
         """
         This queries everything all at once. This is safe if we're joining
@@ -112,30 +221,103 @@ class PermQuerySet(QuerySet):
             self.none()
         )
 
+    @instrumented('query_perms')
     def _query_perms(self,
         roles,
         get_related_prefixes,
         perms_name,
-        force_separate,
+        strategy=None,
         agent=ANY,
-        target=ANY
+        target=ANY,
+        fetch_ids=True
     ):
         """
         This is an abstraction used by subclasses to query permissions.
 
         Roles will be normalized to a list of roles.
 
-        force_separate is an optimization. If you know you are going
-        to have multiple left joins, this will speed things up.
+        strategy picks how the queries for each related prefix are combined,
+        one of TOGETHER, SEPARATE, UNION or SUBQUERY, or AUTO to let the
+        planner choose. By default, the planner chooses if
+        FLEXIBLE_PERMISSIONS_PLANNER is set, and otherwise a single direct
+        query is run together and anything else as a UNION.
 
         Either agent or target can be provided. It's assumed that the
         queryset to be retrieved is the thing not provided.
+
+        If a shared cache is configured, the resolved ids are stored in it,
+        unless there are more than FLEXIBLE_PERMISSIONS_CACHE_MAX_IDS.
+
+        Without fetch_ids, no ids are loaded into memory: the shared cache
+        is skipped and SUBQUERY is run in place of SEPARATE.
         """
         # Normalize inputs
         roles = normalize_value(roles)
         agent = normalize_value(agent)
         target = normalize_value(target)
 
+        annotate(
+            model=self.model.__name__,
+            agents=len(agent) if is_value(agent) else 0
+        )
+
+        cache = get_shared_cache()
+        resolve_args = (
+            roles,
+            get_related_prefixes,
+            perms_name,
+            strategy,
+            agent,
+            target,
+            fetch_ids
+        )
+
+        if cache is None or not fetch_ids:
+            return self._resolve_perms(*resolve_args)
+
+        key = get_shared_key(
+            cache,
+            self,
+            perms_name,
+            roles,
+            agent,
+            target,
+            get_relation_models(self.model)
+        )
+        ids = cache.get(key)
+
+        if ids is None:
+            # Resolve against the whole table so the ids can be reused
+            # by any queryset of this model.
+            queryset = self.__class__(model=self.model, using=self._db)
+            results = queryset._resolve_perms(*resolve_args)
+
+            max_ids = get_shared_max_ids()
+            ids = list(results.values_list('pk', flat=True)[:max_ids + 1])
+
+            if len(ids) > max_ids:
+                ids = TOO_MANY_IDS
+
+            cache.set(key, ids, get_shared_timeout())
+
+        if ids == TOO_MANY_IDS:
+            return self._resolve_perms(*resolve_args)
+
+        return self.filter(pk__in=ids)._clone(_plan={'cached': True})
+
+    def _resolve_perms(
+        self,
+        roles,
+        get_related_prefixes,
+        perms_name,
+        strategy,
+        agent,
+        target,
+        fetch_ids=True
+    ):
+        """
+        Builds the permission query for already normalized inputs.
+        """
         # Get all possible related queries we're doing
         related_prefixes = (
             get_related_prefixes(self, perms_name, *roles)
@@ -143,26 +325,56 @@ class PermQuerySet(QuerySet):
             [perms_name]
         )
 
+        annotate(prefixes=len(related_prefixes))
+
         # Create a query for each related prefix
         queries = [
             self._get_query(roles, agent, target, prefix=prefix)
             for prefix in related_prefixes
         ]
 
+        if strategy is None and is_adaptive():
+            strategy = AUTO
+
+        estimates = None
+
         # Aggregate the queries. Query together if we don't have any
         # divergent left joins.
-        query_together = (
-            not force_separate and
-            len(related_prefixes) <= 1 and
-            perms_name in related_prefixes
-        )
+        if strategy is None:
+            query_together = (
+                len(related_prefixes) <= 1 and
+                perms_name in related_prefixes
+            )
+
+            strategy = TOGETHER if query_together else UNION
+        elif strategy == AUTO:
+            strategy, estimates = choose_strategy(
+                self.model,
+                perms_name,
+                related_prefixes,
+                agent
+            )
 
-        if query_together:
-            results = self._query_together(queries)
-        else:
-            results = self._query_separate(queries)
+        if strategy == SEPARATE and not fetch_ids:
+            strategy = SUBQUERY
 
-        return results
+        return self._combine_queries(queries, strategy, {
+            'strategy': strategy,
+            'prefixes': sorted(related_prefixes),
+            'estimates': estimates,
+        })
+
+    def _combine_queries(self, queries, strategy, plan):
+        annotate(strategy=strategy)
+
+        results = {
+            TOGETHER: self._query_together,
+            SEPARATE: self._query_separate,
+            UNION: self._query_union,
+            SUBQUERY: self._query_subquery,
+        }[strategy](queries)
+
+        return results._clone(_plan=plan)
 
 
 class PermTargetQuerySet(PermQuerySet):
@@ -171,6 +383,34 @@ class PermTargetQuerySet(PermQuerySet):
     via the permissions table. The methods should be read as
     "Get a target for an agent with role x."
     """
+    _allowed_actions = None
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_allowed_actions', self._allowed_actions)
+
+        return super(PermTargetQuerySet, self)._clone(*args, **kwargs)
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(PermTargetQuerySet, self)._fetch_all()
+
+        if fetched and self._allowed_actions is not None:
+            agent, actions, infer_agents, attr = self._allowed_actions
+
+            # values() and friends fetch rows rather than objects
+            objs = [
+                obj for obj in self._result_cache
+                if isinstance(obj, self.model) and obj.pk is not None
+            ]
+
+            if not objs:
+                return
+
+            allowed = get_allowed_actions(agent, objs, actions, infer_agents)
+
+            for obj in objs:
+                setattr(obj, attr, allowed[obj.pk])
+
     def _prefix_actions(self, actions):
         """
         Prepend this model's name as prefix. This enforces more correct
@@ -196,30 +436,143 @@ class PermTargetQuerySet(PermQuerySet):
         roles=ANY,
         agent=ANY,
         infer_agents=True,
-        force_separate=False
+        force_separate=False,
+        strategy=None
     ):
         """
         This filters permission targets by the given agent.
 
         infer_agents is an optimization. If you know you don't need the
         authority of any related agents, set it to false.
+
+        strategy overrides how related queries are combined; see
+        _query_perms. force_separate is shorthand for SEPARATE.
+
+        If a cache scope is open, the resolved ids are memoized for the
+        rest of the scope.
         """
+        strategy = get_strategy(strategy, force_separate)
+        cache = get_request_cache('targets')
+
+        if cache is None:
+            return self._query_targets(
+                roles,
+                self._normalize_agent(agent, infer_agents),
+                strategy
+            )
+
+        key = get_targets_key(self, roles, agent, infer_agents)
+
+        if key not in cache:
+            agents = self._normalize_agent(agent, infer_agents)
+
+            # Resolve against the whole table so the ids can be reused
+            # by any queryset of this model.
+            queryset = self.__class__(model=self.model, using=self._db)
+            results = queryset._query_targets(roles, agents, strategy)
+            ids = set(results.values_list('pk', flat=True))
+
+            cache[key] = CachedTargets(roles, agents, ids)
+
+        return self.filter(pk__in=cache[key].ids)._clone(
+            _plan={'cached': True}
+        )
+
+    def iter_for_role(
+        self,
+        roles=ANY,
+        agent=ANY,
+        infer_agents=True,
+        strategy=None,
+        chunk_size=ITER_CHUNK_SIZE
+    ):
+        """
+        Like for_role, but yields the targets in pk order, loading only
+        chunk_size of them at a time. Both caches are bypassed, and
+        SUBQUERY is run in place of SEPARATE, so no ids are fetched up
+        front and memory stays bounded.
+        """
+        results = self._query_targets(
+            roles,
+            self._normalize_agent(agent, infer_agents),
+            strategy,
+            fetch_ids=False
+        )
+
+        return iterate_keyset(results, chunk_size)
+
+    def _normalize_agent(self, agent, infer_agents):
+        return normalize_value(
+            agent,
+            normalize_agent,
+            infer_agents=infer_agents
+        )
+
+    def _query_targets(self, roles, agents, strategy, fetch_ids=True):
         return self._query_perms(
             roles=roles,
             get_related_prefixes=get_related_target_prefixes,
             perms_name='target_perms',
-            force_separate=force_separate,
-            agent=normalize_value(
-                agent,
-                normalize_agent,
-                infer_agents=infer_agents
-            )
+            strategy=strategy,
+            agent=agents,
+            fetch_ids=fetch_ids
         )
 
     def for_action(self, actions=ANY, *args, **kwargs):
-        roles = actions_to_roles(self._prefix_actions(actions))
+        actions = self._prefix_actions(actions)
+
+        if effective.is_enabled() and is_value(actions):
+            return self._for_effective_action(actions, *args, **kwargs)
+
+        roles = actions_to_roles(actions)
         return self.for_role(roles, *args, **kwargs)
 
+    def iter_for_action(self, actions=ANY, *args, **kwargs):
+        roles = actions_to_roles(self._prefix_actions(actions))
+        return self.iter_for_role(roles, *args, **kwargs)
+
+    def _for_effective_action(
+        self,
+        actions,
+        agent=ANY,
+        infer_agents=True,
+        force_separate=False,
+        strategy=None
+    ):
+        """
+        Looks targets up in the EffectivePermission table, which already
+        accounts for related objects.
+        """
+        perms = EffectivePermission.objects.filter(
+            self._get_agent_query(self._normalize_agent(agent, infer_agents)),
+            action__in=actions,
+            target_type_id=get_content_type_id(self.model)
+        )
+
+        return self.filter(pk__in=perms.values('target_id'))._clone(
+            _plan={'strategy': EFFECTIVE}
+        )
+
+    def with_allowed_actions(
+        self,
+        agent=ANY,
+        actions=ANY,
+        infer_agents=True,
+        attr='allowed_actions'
+    ):
+        """
+        Like prefetch_related, sets attr on each object fetched to the set
+        of actions agent may take on it, with one extra query for all of
+        them. actions are given without their prefix, and default to all
+        of this model's actions.
+        """
+        if is_value(actions):
+            self._prefix_actions(actions)
+
+        return self._clone(
+            _allowed_actions=(agent, actions, infer_agents, attr)
+        )
+
 
 class PermAgentQuerySet(PermQuerySet):
     """
@@ -238,20 +591,128 @@ class PermAgentQuerySet(PermQuerySet):
 
         return actions
 
-    def with_role(self, roles=ANY, target=ANY, force_separate=False):
+    def _get_role_prefixes(self, model):
+        """
+        Roles with these prefixes apply to targets of model.
+        """
+        return set([get_model_name(model)]) | set(get_compiled_paths(model))
+
+    def _get_targets_by_model(self, targets):
+        pks_by_model = {}
+        for target in ensure_plural(targets):
+            pks_by_model.setdefault(target.__class__, []).append(target.pk)
+
+        return pks_by_model
+
+    def _validate_related_roles(self, roles, targets):
+        if not is_value(roles):
+            return
+
+        for model in self._get_targets_by_model(targets):
+            role_prefixes = self._get_role_prefixes(model)
+
+            for role in normalize_value(roles):
+                if role.split(".")[0] not in role_prefixes:
+                    raise ValueError("Role %s is invalid for %s" % (
+                        role,
+                        get_model_name(model)
+                    ))
+
+    def _with_role_on_targets(self, roles, targets, strategy):
+        """
+        Finds agents holding roles on targets, directly or on anything
+        they're related to. Agents that inherit such a grant, through
+        their registered paths or from a parent, are included. This takes
+        a query for relations, then the holders stay in subqueries, one
+        for each way an agent can hold a grant, combined by strategy.
+        """
+        roles = normalize_value(roles)
+        grant_query = reduce(operator.or_, [
+            _get_grant_query(_get_candidates(model, pks), roles, ANY, False)
+            for model, pks in self._get_targets_by_model(targets).items()
+        ], Q(id__isnull=True))
+
+        grants = Permission.objects.filter(grant_query)
+
+        def get_holder_ids(model):
+            return grants.filter(
+                agent_type_id=get_content_type_id(model)
+            ).values('agent_id')
+
+        def get_agent_query(key, model):
+            query = Q(**{key + '__in': get_holder_ids(model)})
+            descendant_ids = get_descendant_ids(model, get_holder_ids)
+
+            if descendant_ids is not None:
+                query |= Q(**{key + '__in': descendant_ids})
+
+            return query
+
+        queryset = self.__class__(model=self.model, using=self._db)
+        queries = [get_agent_query('pk', self.model)]
+
+        for path in get_agent_paths(self.model):
+            subpath, path_model = get_path_models(self.model, path)[-1]
+
+            # As ids, so multi-valued paths don't repeat agents
+            queries.append(Q(pk__in=(
+                queryset
+                .filter(get_agent_query(path, path_model))
+                .order_by()
+                .values('pk')
+            )))
+
+        # Every query is on ids, so combining them needs no extra joins
+        if strategy in (None, AUTO):
+            strategy = TOGETHER
+
+        return self._combine_queries(queries, strategy, {
+            'strategy': strategy,
+            'prefixes': ['agent_perms'] + list(get_agent_paths(self.model)),
+            'estimates': None,
+        })
+
+    def with_role(
+        self,
+        roles=ANY,
+        target=ANY,
+        force_separate=False,
+        strategy=None
+    ):
         """
         This filters permission agents by the given target.
+
+        For concrete targets, roles held on objects the targets are
+        related to count too, so roles may be prefixed by any of them.
         """
+        if is_value(target):
+            self._validate_related_roles(roles, target)
+            return self._with_role_on_targets(
+                roles,
+                target,
+                get_strategy(strategy, force_separate)
+            )
+
         validate_roles_with_targets(roles, target)
 
         return self._query_perms(
             roles=roles,
             get_related_prefixes=get_related_agent_prefixes,
             perms_name='agent_perms',
-            force_separate=force_separate,
+            strategy=get_strategy(strategy, force_separate),
             target=target
         )
 
-    def with_action(self, actions=ANY, *args, **kwargs):
+    def with_action(self, actions=ANY, target=ANY, *args, **kwargs):
         roles = actions_to_roles(self._validate_actions(actions))
-        return self.with_role(roles, *args, **kwargs)
+
+        # Only some of the roles may apply to these targets
+        if is_value(roles) and is_value(target):
+            for model in self._get_targets_by_model(target):
+                role_prefixes = self._get_role_prefixes(model)
+                roles = [
+                    role for role in roles
+                    if role.split(".")[0] in role_prefixes
+                ]
+
+        return self.with_role(roles, target, *args, **kwargs)
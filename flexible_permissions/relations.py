@@ -1,9 +1,37 @@
+from django.apps import apps
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
+
+from flexible_permissions.cache import (
+    bump_model_generations,
+    get_request_cache,
+)
+from flexible_permissions._utils import ensure_plural, get_content_type_id
+
 _relation_registry = {}
 
+"""
+Registered paths are compiled on first use for each model, and the
+compiled forms are thrown away whenever a relation is registered.
+"""
+_compiled_paths = {}
+_compiled_prefixes = {}
+_path_models = {}
+_multi_valued_paths = {}
+_relation_models = {}
+_relation_model_flags = {}
+
 
 def register_relation(cls, paths):
     _relation_registry[cls] = paths
 
+    _compiled_paths.clear()
+    _compiled_prefixes.clear()
+    _relation_models.clear()
+    _relation_model_flags.clear()
+
+    _connect_relation_receivers()
+
 
 def get_relation_paths(cls):
     """
@@ -20,30 +48,282 @@ def get_relation_paths(cls):
     return results
 
 
-def get_related_target_prefixes(queryset, perms_name, *roles):
-    paths = get_relation_paths(queryset.model)
-    prefixes = []
+def get_compiled_paths(cls):
+    """
+    Like get_relation_paths, but memoized, and with every value a tuple
+    of paths.
+    """
+    if cls not in _compiled_paths:
+        _compiled_paths[cls] = dict(
+            (role_prefix, tuple(ensure_plural(paths)))
+            for role_prefix, paths in get_relation_paths(cls).items()
+        )
+
+    return _compiled_paths[cls]
 
-    if perms_name in queryset.model._meta.get_all_field_names():
-        prefixes.append(perms_name)
 
-    for role in roles:
-        role_prefix = role.split(".")[0]
+def _get_prefixes(cls, perms_name, roles):
+    key = (cls, perms_name, roles)
 
-        # Add in the path to the related object, plus perm
-        if role_prefix in paths:
-            if not isinstance(paths[role_prefix], list):
-                paths[role_prefix] = [paths[role_prefix]]
-            for path in paths[role_prefix]:
+    if key not in _compiled_prefixes:
+        paths = get_compiled_paths(cls)
+        prefixes = []
+
+        if perms_name in cls._meta.get_all_field_names():
+            prefixes.append(perms_name)
+
+        for role in roles:
+            # Add in the path to the related object, plus perm
+            for path in paths.get(role.split(".")[0], ()):
                 prefixes.append(path + '__' + perms_name)
 
-    return set(prefixes)
+        _compiled_prefixes[key] = frozenset(prefixes)
+
+    return _compiled_prefixes[key]
+
+
+def is_multi_valued(cls, path):
+    """
+    Whether path from cls can lead to more than one object.
+    """
+    key = (cls, path)
+
+    if key not in _multi_valued_paths:
+        multi_valued = False
+
+        for part in path.split('__'):
+            field = cls._meta.get_field(part)
+            multi_valued |= bool(field.many_to_many or field.one_to_many)
+            cls = field.related_model
+
+        _multi_valued_paths[key] = multi_valued
+
+    return _multi_valued_paths[key]
+
+
+def get_relation_models(cls):
+    """
+    Gets cls and every model its registered paths pass through, whose rows
+    decide which objects of cls a permission reaches.
+    """
+    if cls not in _relation_models:
+        models = set([cls])
+
+        for paths in get_compiled_paths(cls).values():
+            for path in paths:
+                models.update(
+                    path_model
+                    for subpath, path_model in get_path_models(cls, path)
+                )
+
+        _relation_models[cls] = frozenset(models)
+
+    return _relation_models[cls]
+
+
+def is_relation_model(cls):
+    """
+    Whether saving or deleting objects of cls can change which objects
+    permissions reach through registered relations.
+    """
+    if cls not in _relation_model_flags:
+        _relation_model_flags[cls] = bool(get_compiled_paths(cls)) or bool([
+            model for model in _relation_registry
+            if [
+                related_model for related_model in get_relation_models(model)
+                if issubclass(cls, related_model)
+            ]
+        ])
+
+    return _relation_model_flags[cls]
+
+
+def get_relation_senders():
+    """
+    Gets every installed model that is_relation_model, i.e. the senders
+    whose saves and deletes are worth listening to.
+    """
+    return [model for model in apps.get_models() if is_relation_model(model)]
+
+
+"""
+Receivers of saves and deletes are connected only for relation models, as
+relations are registered. Listening to every model would cost a call per
+row, and would stop Django from deleting any model's rows in bulk.
+"""
+_relation_receivers = []
+
+
+def _connect_relation_receivers():
+    if not apps.models_ready:
+        return
+
+    for model in get_relation_senders():
+        for signal, fn in _relation_receivers:
+            signal.connect(fn, sender=model)
+
+
+def relation_receiver(signal):
+    """
+    Like django.dispatch.receiver, but connects the decorated function to
+    signal for relation models only.
+    """
+    def decorator(fn):
+        _relation_receivers.append((signal, fn))
+        _connect_relation_receivers()
+
+        return fn
+
+    return decorator
+
+
+def get_related_target_prefixes(queryset, perms_name, *roles):
+    return _get_prefixes(queryset.model, perms_name, frozenset(roles))
 
 
 def get_related_agent_prefixes(queryset, perms_name, *roles):
-    prefixes = []
+    return _get_prefixes(queryset.model, perms_name, frozenset())
+
+
+def get_path_models(cls, path):
+    """
+    Returns a (subpath, model) pair for each step along path from cls,
+    e.g. exhibit__zoo gives [('exhibit', Exhibit), ('exhibit__zoo', Zoo)].
+    """
+    key = (cls, path)
+
+    if key not in _path_models:
+        results = []
+        parts = path.split('__')
+
+        for index, part in enumerate(parts):
+            cls = cls._meta.get_field(part).related_model
+            results.append(('__'.join(parts[:index + 1]), cls))
+
+        _path_models[key] = results
+
+    return _path_models[key]
+
+
+"""
+Ancestors of concrete targets, memoized in the request cache
+"""
+
+
+def get_model_target_ancestors(model, pks, queryset=None):
+    """
+    Gets every object reachable through registered relations from each of
+    the objects of model with the given pks, for the ones not already in
+    the request cache. Single valued paths take one query between them,
+    and each multi-valued path one more. Returns a dict of each pk to a
+    list of (content type id, id, role prefix).
+
+    queryset, if given, is used instead of pks to select the objects.
+    """
+    paths = [
+        (role_prefix, path, get_content_type_id(path_models[-1][1]))
+        for role_prefix, paths in get_compiled_paths(model).items()
+        for path in paths
+        for path_models in [get_path_models(model, path)]
+    ]
+
+    if not paths:
+        if queryset is not None:
+            pks = queryset.values_list('pk', flat=True)
+
+        return dict((pk, []) for pk in pks)
+
+    cache = get_request_cache('ancestors')
+    if cache is None:
+        cache = {}
+
+    if queryset is None:
+        result = dict(
+            (pk, cache[(model, pk)]) for pk in pks if (model, pk) in cache
+        )
+        pks = [pk for pk in pks if pk not in result]
+
+        if not pks:
+            return result
+
+        queryset = model._default_manager.filter(pk__in=pks)
+    else:
+        result = {}
+
+    # Single valued paths are read together. A multi-valued path gets its
+    # own query, or its rows would multiply with every other path's.
+    groups = [[
+        path for path in paths if not is_multi_valued(model, path[1])
+    ]] + [
+        [path] for path in paths if is_multi_valued(model, path[1])
+    ]
+
+    for group in groups:
+        if not group:
+            continue
+
+        rows = queryset.values_list(
+            'pk',
+            *[path for role_prefix, path, type_id in group]
+        )
+
+        for row in rows:
+            ancestors = result.setdefault(row[0], [])
+
+            for (role_prefix, path, type_id), related_pk in zip(
+                group,
+                row[1:]
+            ):
+                if related_pk is not None:
+                    ancestors.append((type_id, related_pk, role_prefix))
+
+    for pk, ancestors in result.items():
+        cache[(model, pk)] = ancestors
+
+    return result
+
+
+def get_target_ancestors(objs):
+    """
+    Like get_model_target_ancestors, for a queryset or a list of objects of
+    one model.
+    """
+    if isinstance(objs, QuerySet):
+        return get_model_target_ancestors(objs.model, None, objs)
+
+    objs = list(objs)
+
+    if not objs:
+        return {}
+
+    return get_model_target_ancestors(
+        objs[0].__class__,
+        [obj.pk for obj in objs]
+    )
+
+
+@relation_receiver(post_save)
+@relation_receiver(post_delete)
+def invalidate_ancestors(sender, **kwargs):
+    cache = get_request_cache('ancestors')
+
+    if cache:
+        cache.clear()
+
+
+@relation_receiver(post_save)
+@relation_receiver(post_delete)
+def invalidate_related_targets(sender, **kwargs):
+    if not is_relation_model(sender):
+        return
 
-    if perms_name in queryset.model._meta.get_all_field_names():
-        prefixes.append(perms_name)
+    bump_model_generations([sender])
 
-    return set(prefixes)
+    # Request cache keys start with the queried model
+    cache = get_request_cache('targets')
+    for key in list(cache or ()):
+        if [
+            model for model in get_relation_models(key[0])
+            if issubclass(sender, model)
+        ]:
+            del cache[key]
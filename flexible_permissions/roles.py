@@ -1,27 +1,36 @@
-from flexible_permissions._utils import ensure_plural, is_value
+from flexible_permissions.instrumentation import instrumented
+from flexible_permissions._utils import ensure_plural, get_role_id, is_value
 
 """
-Maps of roles to actions
+Maps of roles to actions. Both are kept in sync incrementally as roles are
+registered, and values are frozensets of interned strings.
 """
 
 ROLES = {}
 ACTIONS = {}
 
+"""
+Expansions of particular sets of roles or actions, cleared whenever a role
+is registered.
+"""
 
-def calculate_actions(roles):
-    result = {}
-    for role, actions in roles.items():
-        for action in actions:
-            result.setdefault(action, [])
-            result[action].append(role)
-            result[action] = list(set(result[action]))
+_interned = {}
+_roles_to_actions = {}
+_actions_to_roles = {}
+_prefixed_roles = {}
 
-    return result
+"""
+Role names by id, to catch collisions
+"""
 
+_role_ids = {}
 
-def register_role(name, actions):
-    global ACTIONS
 
+def _intern(value):
+    return _interned.setdefault(value, value)
+
+
+def register_role(name, actions):
     for action in actions:
         if action.count(".") != 1:
             raise ValueError(
@@ -30,12 +39,37 @@ def register_role(name, actions):
                 "action."
             )
 
+    role_id = get_role_id(name)
+    if _role_ids.setdefault(role_id, name) != name:
+        raise ValueError("Role %s has the same id as %s." % (
+            name,
+            _role_ids[role_id]
+        ))
+
+    name = _intern(name)
+    actions = frozenset(_intern(action) for action in actions)
+
     # Merge the actions together
-    pre_existing_actions = ROLES.get(name, [])
-    ROLES[name] = list(set(actions + pre_existing_actions))
+    ROLES[name] = ROLES.get(name, frozenset()) | actions
 
     # Keep action map in sync
-    ACTIONS = calculate_actions(ROLES)
+    for action in actions:
+        ACTIONS[action] = ACTIONS.get(action, frozenset()) | set([name])
+
+    _roles_to_actions.clear()
+    _actions_to_roles.clear()
+    _prefixed_roles.clear()
+
+
+def _expand(values, mapping, cache):
+    key = frozenset(ensure_plural(values))
+
+    if key not in cache:
+        cache[key] = frozenset(
+            result for value in key for result in mapping[value]
+        )
+
+    return cache[key]
 
 
 def roles_to_actions(roles):
@@ -43,14 +77,25 @@ def roles_to_actions(roles):
     if not is_value(roles):
         return roles
 
-    roles = ensure_plural(roles)
-    return list(set([action for role in roles for action in ROLES[role]]))
+    return _expand(roles, ROLES, _roles_to_actions)
 
 
+@instrumented('actions_to_roles')
 def actions_to_roles(actions):
     # Keep special values
     if not is_value(actions):
         return actions
 
-    actions = ensure_plural(actions)
-    return list(set([role for action in actions for role in ACTIONS[action]]))
+    return _expand(actions, ACTIONS, _actions_to_roles)
+
+
+def get_prefixed_roles(prefix):
+    """
+    Gets the registered roles that start with prefix, e.g. "zoo".
+    """
+    if prefix not in _prefixed_roles:
+        _prefixed_roles[prefix] = frozenset(
+            role for role in ROLES if role.startswith(prefix + '.')
+        )
+
+    return _prefixed_roles[prefix]
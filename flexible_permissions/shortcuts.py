@@ -1,18 +1,122 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q, QuerySet
+
+import operator
+
 # Include ANY and NULL as part of the public api
 from flexible_permissions._utils import (
     ANY,
+    IN_CHUNK_SIZE,
+    ITER_CHUNK_SIZE,
     NULL,
+    chunked,
+    ensure_plural,
+    filter_isnull,
+    generic_in,
+    get_content_type_id,
+    get_model_name,
+    get_roles_query,
+    is_value,
+    iterate_keyset,
+    normalize_value,
+    use_role_ids,
     validate_roles_with_targets,
     get_multi_crud_query,
     get_single_crud_kwargs,
 )
+from flexible_permissions.agents import normalize_agent
+from flexible_permissions.changes import ADD, REMOVE, ROW_FIELDS, log_changes
+from flexible_permissions.instrumentation import instrumented
 from flexible_permissions.models import Permission
+from flexible_permissions.relations import get_model_target_ancestors
+from flexible_permissions.roles import (
+    ACTIONS,
+    ROLES,
+    actions_to_roles,
+    get_prefixed_roles,
+)
+from flexible_permissions.signals import permissions_changed
+
+"""
+Change notification
+"""
+
+
+def _perms_changed(roles, agents, targets, target_models=None):
+    permissions_changed.send(
+        sender=Permission,
+        roles=roles,
+        agents=agents,
+        targets=targets,
+        target_models=target_models
+    )
+
+
+def _get_row(perm):
+    return tuple(getattr(perm, field) for field in ROW_FIELDS)
+
+
+def _create_perms(perms):
+    """
+    Inserts perms and logs them.
+    """
+    Permission.objects.bulk_create(perms)
+    log_changes(ADD, [_get_row(perm) for perm in perms])
+
+
+def _get_target_models(rows):
+    """
+    Gets the models of the targets of rows, skipping null targets.
+    """
+    return set(
+        ContentType.objects.get_for_id(row[3]).model_class()
+        for row in rows if row[3] is not None
+    )
+
+
+def _consume_rows(perms):
+    """
+    Yields lists of at most IN_CHUNK_SIZE (pk,) + ROW_FIELDS rows of the
+    perms queryset. Callers must take each list's rows out of perms before
+    asking for the next, since every read starts from the top.
+    """
+    while True:
+        rows = list(perms.values_list('pk', *ROW_FIELDS)[:IN_CHUNK_SIZE])
+
+        if rows:
+            yield rows
+
+        if len(rows) < IN_CHUNK_SIZE:
+            return
+
+
+def _delete_perms(perms):
+    """
+    Deletes the Permissions in the perms queryset and logs them, at most
+    IN_CHUNK_SIZE at a time. Returns how many were deleted and the set of
+    models their targets belong to.
+    """
+    deleted, target_models = 0, set()
+
+    for rows in _consume_rows(perms):
+        Permission.objects.filter(pk__in=[row[0] for row in rows]).delete()
+
+        rows = [row[1:] for row in rows]
+        log_changes(REMOVE, rows)
+
+        deleted += len(rows)
+        target_models |= _get_target_models(rows)
+
+    return deleted, target_models
+
 
 """
 Get
 """
 
 
+@instrumented('get_perms')
 def get_perms(*args, **kwargs):
     """
     Gets all Permissions matching the query.
@@ -21,11 +125,188 @@ def get_perms(*args, **kwargs):
     return Permission.objects.filter(get_multi_crud_query(*args, **kwargs))
 
 
+def iter_perms(role=NULL, agent=NULL, target=NULL, chunk_size=ITER_CHUNK_SIZE):
+    """
+    Like get_perms, but yields the Permissions in pk order, loading only
+    chunk_size of them at a time.
+    """
+    return iterate_keyset(get_perms(role, agent, target), chunk_size)
+
+
+"""
+Check
+"""
+
+
+def _get_candidates(model, pks):
+    """
+    Finds every object a Permission could be granted on to apply to the
+    objects of model with the given pks, following registered relations.
+    Returns a dict of (content type id, id) to a list of (pk, role prefix)
+    pairs, where the role prefix is None for the objects themselves.
+    """
+    content_type_id = get_content_type_id(model)
+    candidates = dict(
+        ((content_type_id, pk), [(pk, None)]) for pk in pks
+    )
+
+    ancestors = get_model_target_ancestors(model, pks)
+    for pk, related in ancestors.items():
+        for type_id, related_pk, role_prefix in related:
+            candidates.setdefault((type_id, related_pk), []).append(
+                (pk, role_prefix)
+            )
+
+    return candidates
+
+
+def _get_grant_query(candidates, roles, agent, infer_agents):
+    """
+    Builds a query for the Permissions agent holds with any of roles on
+    any of the candidates, respecting the role prefix of each.
+    """
+    agent = normalize_value(agent, normalize_agent, infer_agents=infer_agents)
+
+    if agent is NULL:
+        agent_query = filter_isnull('agent')
+    elif is_value(agent):
+        agent_query = filter_isnull('agent') | generic_in('agent', agent)
+    else:
+        agent_query = Q()
+
+    # Group candidates that accept the same roles into one clause
+    ids_by_roles = {}
+    for (type_id, pk), objects in candidates.items():
+        for obj_pk, role_prefix in objects:
+            key = (type_id, role_prefix)
+            ids_by_roles.setdefault(key, set()).add(pk)
+
+    target_clauses = [Q(id__isnull=True)]
+    for (type_id, role_prefix), ids in ids_by_roles.items():
+        clause = Q(target_type_id=type_id, target_id__in=list(ids))
+
+        if role_prefix is not None and use_role_ids():
+            clause &= get_roles_query(get_prefixed_roles(role_prefix))
+        elif role_prefix is not None:
+            clause &= Q(role__startswith=role_prefix + '.')
+
+        target_clauses.append(clause)
+
+    query = agent_query & reduce(operator.or_, target_clauses)
+
+    if is_value(roles):
+        query &= get_roles_query(roles)
+
+    return query
+
+
+def _prefix_action(model, action):
+    if "." in action:
+        raise ValueError(
+            "Prefixes are inferred. Register this with its own actions."
+        )
+
+    return "%s.%s" % (get_model_name(model), action)
+
+
+def _get_action_roles(model, action):
+    return actions_to_roles(_prefix_action(model, action))
+
+
+@instrumented('has_perm')
+def has_perm(agent, action, obj, infer_agents=True):
+    """
+    Whether agent may take action on obj, directly or through registered
+    relations. Like for_action, action is given without its prefix.
+    """
+    roles = _get_action_roles(obj.__class__, action)
+    candidates = _get_candidates(obj.__class__, [obj.pk])
+
+    return Permission.objects.filter(
+        _get_grant_query(candidates, roles, agent, infer_agents)
+    ).exists()
+
+
+@instrumented('has_perms')
+def has_perms(agent, action, objs, infer_agents=True):
+    """
+    Like has_perm, but for many objects of one model at once. Returns a
+    dict of each object's pk to whether agent may take action on it.
+    """
+    objs = list(objs)
+
+    if not objs:
+        return {}
+
+    model = objs[0].__class__
+    roles = _get_action_roles(model, action)
+    candidates = _get_candidates(model, [obj.pk for obj in objs])
+
+    perms = Permission.objects.filter(
+        _get_grant_query(candidates, roles, agent, infer_agents)
+    ).values_list('role', 'target_type_id', 'target_id')
+
+    result = dict((obj.pk, False) for obj in objs)
+    for role, target_type_id, target_id in perms:
+        for obj_pk, role_prefix in candidates[(target_type_id, target_id)]:
+            if role_prefix is None or role.startswith(role_prefix + '.'):
+                result[obj_pk] = True
+
+    return result
+
+
+@instrumented('get_allowed_actions')
+def get_allowed_actions(agent, objs, actions=ANY, infer_agents=True):
+    """
+    Finds which of actions agent may take on each of objs, which must be
+    of one model. actions are given without their prefix, and default to
+    all of the model's actions. Returns a dict of each object's pk to a
+    set of actions.
+    """
+    objs = list(objs)
+
+    if not objs:
+        return {}
+
+    model = objs[0].__class__
+    prefix = get_model_name(model) + '.'
+
+    if is_value(actions):
+        actions = set(
+            _prefix_action(model, action) for action in ensure_plural(actions)
+        )
+    else:
+        actions = set(
+            action for action in ACTIONS if action.startswith(prefix)
+        )
+
+    roles = actions_to_roles(actions)
+    candidates = _get_candidates(model, [obj.pk for obj in objs])
+
+    perms = Permission.objects.filter(
+        _get_grant_query(candidates, roles, agent, infer_agents)
+    ).values_list('role', 'target_type_id', 'target_id')
+
+    result = dict((obj.pk, set()) for obj in objs)
+    for role, target_type_id, target_id in perms:
+        granted = set(
+            action[len(prefix):]
+            for action in ROLES.get(role, frozenset()) & actions
+        )
+
+        for obj_pk, role_prefix in candidates[(target_type_id, target_id)]:
+            if role_prefix is None or role.startswith(role_prefix + '.'):
+                result[obj_pk] |= granted
+
+    return result
+
+
 """
 Create
 """
 
 
+@instrumented('add_perm')
 def add_perm(role, agent, target):
     """
     Adds a single Permission matching the arguments.
@@ -37,7 +318,20 @@ def add_perm(role, agent, target):
 
     # If it already exists, this is a duplicate, so ignore it.
     query_kwargs = get_single_crud_kwargs(role, agent, target)
-    return Permission.objects.get_or_create(**query_kwargs)[0]
+
+    with transaction.atomic():
+        perm, created = Permission.objects.get_or_create(
+            defaults={'role': role},
+            **query_kwargs
+        )
+
+        if created:
+            log_changes(ADD, [_get_row(perm)])
+
+    if created:
+        _perms_changed(role, agent, target)
+
+    return perm
 
 
 """
@@ -45,13 +339,20 @@ Delete
 """
 
 
-def remove_perm(*args, **kwargs):
+@instrumented('remove_perm')
+def remove_perm(role, agent, target):
     """
     Removes all Permissions matching the arguments.
     Accepts role, agent, and target kwargs.
     """
-    query_kwargs = get_single_crud_kwargs(*args, **kwargs)
-    Permission.objects.filter(**query_kwargs).delete()
+    query_kwargs = get_single_crud_kwargs(role, agent, target)
+
+    with transaction.atomic():
+        removed, target_models = _delete_perms(
+            Permission.objects.filter(**query_kwargs)
+        )
+
+    _perms_changed(role, agent, target, target_models)
 
 
 """
@@ -59,6 +360,7 @@ Update
 """
 
 
+@instrumented('assign_role')
 def assign_role(role, agent, target):
     """
     Removes role for target from all other agents and assigns it to the
@@ -66,3 +368,248 @@ def assign_role(role, agent, target):
     """
     remove_perm(role, ANY, target)
     add_perm(role, agent, target)
+
+
+@instrumented('assign_roles')
+def assign_roles(role, agent, targets):
+    """
+    Like assign_role, but for many targets at once. agent may be NULL.
+    Runs a fixed number of statements however many targets there are, and
+    returns a (removed, created) pair of Permission counts.
+    """
+    validate_roles_with_targets(role, targets)
+
+    targets = list(ensure_plural(targets))
+    agent_query = get_multi_crud_query(ANY, agent, ANY)
+
+    with transaction.atomic():
+        perms = Permission.objects.filter(
+            get_multi_crud_query(role, ANY, targets)
+        )
+
+        removed, target_models = _delete_perms(perms.exclude(agent_query))
+
+        existing = set(
+            perms.filter(agent_query).values_list('target_type', 'target_id')
+        )
+
+        agent_type_id, agent_id = (
+            (None, None)
+            if agent is NULL else
+            _get_type_ids([agent])[0]
+        )
+
+        missing = [
+            Permission(
+                role=role,
+                agent_type_id=agent_type_id,
+                agent_id=agent_id,
+                target_type_id=target_type_id,
+                target_id=target_id
+            )
+            for target_type_id, target_id in set(_get_type_ids(targets))
+            if (target_type_id, target_id) not in existing
+        ]
+
+        _create_perms(missing)
+
+    if removed or missing:
+        _perms_changed(role, ANY, targets)
+
+    return removed, len(missing)
+
+
+@instrumented('transfer_perms')
+def transfer_perms(from_agent, to_agent, roles=ANY, targets=ANY):
+    """
+    Moves from_agent's Permissions matching roles and targets to to_agent.
+    Permissions to_agent already holds are dropped instead. Runs a fixed
+    number of statements per IN_CHUNK_SIZE Permissions, and returns a
+    (moved, dropped) pair of counts. Transferring to the same agent
+    changes nothing.
+    """
+    validate_roles_with_targets(roles, targets)
+
+    if from_agent == to_agent:
+        return 0, 0
+
+    if is_value(targets):
+        targets = list(ensure_plural(targets))
+
+    to_type_id, to_id = _get_type_ids([to_agent])[0]
+
+    perms = get_perms(roles, from_agent, targets)
+    moved_count, dropped_count, target_models = 0, 0, set()
+
+    with transaction.atomic():
+        # Every row read is moved or dropped, so it leaves perms
+        for rows in _consume_rows(perms):
+            target_ids = set(row[5] for row in rows)
+            target_query = Q(target_id__in=[
+                target_id for target_id in target_ids if target_id is not None
+            ])
+
+            if None in target_ids:
+                target_query |= Q(target_id__isnull=True)
+
+            existing = set(
+                get_perms(roles, to_agent, ANY)
+                .filter(target_query)
+                .values_list('role', 'target_type', 'target_id')
+            )
+
+            moved, dropped = [], []
+            for row in rows:
+                if (row[1], row[4], row[5]) in existing:
+                    dropped.append(row)
+                else:
+                    moved.append(row)
+
+            Permission.objects.filter(
+                pk__in=[row[0] for row in dropped]
+            ).delete()
+            Permission.objects.filter(
+                pk__in=[row[0] for row in moved]
+            ).update(agent_type_id=to_type_id, agent_id=to_id)
+
+            rows = [row[1:] for row in rows]
+            log_changes(REMOVE, rows)
+            log_changes(ADD, [
+                (row[1], to_type_id, to_id) + row[4:] for row in moved
+            ])
+
+            moved_count += len(moved)
+            dropped_count += len(dropped)
+            target_models |= _get_target_models(rows)
+
+    if moved_count or dropped_count:
+        _perms_changed(
+            roles,
+            [from_agent, to_agent],
+            targets,
+            target_models
+        )
+
+    return moved_count, dropped_count
+
+
+"""
+Bulk operations
+"""
+
+BULK_BATCH_SIZE = 1000
+
+
+def _get_type_ids(items):
+    """
+    Gets (content type id, id) pairs for items.
+    """
+    return [(get_content_type_id(item), item.id) for item in items]
+
+
+@instrumented('bulk_add_perms')
+def bulk_add_perms(roles, agents, targets, batch_size=BULK_BATCH_SIZE):
+    """
+    Adds a Permission for every combination of roles, agents and targets,
+    skipping the ones that already exist. agents may be NULL. Agents and
+    targets are processed in batches of at most about batch_size rows,
+    with one query to find existing rows per batch. Returns the number of
+    Permissions created.
+    """
+    validate_roles_with_targets(roles, targets)
+
+    roles = sorted(set(ensure_plural(roles)))
+
+    if not roles:
+        return 0
+
+    if agents is NULL:
+        agent_chunks = [NULL]
+    else:
+        agents = list(set(ensure_plural(agents)))
+        agent_chunks = chunked(agents, max(1, batch_size // len(roles)))
+
+    # Targets are gone through once per chunk of agents. A queryset is
+    # streamed each time, and only its model is passed on to receivers.
+    if isinstance(targets, QuerySet):
+        changed_targets, target_models = ANY, set([targets.model])
+    else:
+        targets = ensure_plural(targets)
+        changed_targets, target_models = targets, None
+
+    created = 0
+    with transaction.atomic():
+        for agent_chunk in agent_chunks:
+            agent_ids = (
+                [(None, None)]
+                if agent_chunk is NULL else
+                _get_type_ids(agent_chunk)
+            )
+            target_size = max(1, batch_size // (len(roles) * len(agent_ids)))
+
+            for chunk in chunked(targets, target_size):
+                target_ids = set(_get_type_ids(chunk))
+                existing = set(
+                    Permission.objects
+                    .filter(get_multi_crud_query(roles, agent_chunk, chunk))
+                    .values_list(
+                        'role',
+                        'agent_type',
+                        'agent_id',
+                        'target_type',
+                        'target_id'
+                    )
+                )
+
+                missing = [
+                    Permission(
+                        role=role,
+                        agent_type_id=agent_type_id,
+                        agent_id=agent_id,
+                        target_type_id=target_type_id,
+                        target_id=target_id
+                    )
+                    for role in roles
+                    for agent_type_id, agent_id in agent_ids
+                    for target_type_id, target_id in target_ids
+                    if (
+                        role,
+                        agent_type_id,
+                        agent_id,
+                        target_type_id,
+                        target_id
+                    ) not in existing
+                ]
+
+                _create_perms(missing)
+                created += len(missing)
+
+    if created:
+        _perms_changed(roles, agents, changed_targets, target_models)
+
+    return created
+
+
+@instrumented('bulk_remove_perms')
+def bulk_remove_perms(roles, agents, targets, batch_size=BULK_BATCH_SIZE):
+    """
+    Removes all Permissions matching the arguments, batch_size targets at
+    a time and at most IN_CHUNK_SIZE rows per DELETE. Each argument may be
+    plural, ANY or NULL. Returns the number of Permissions removed.
+    """
+    chunks = chunked(targets, batch_size) if is_value(targets) else [targets]
+
+    removed, target_models = 0, set()
+    with transaction.atomic():
+        for chunk in chunks:
+            count, models = _delete_perms(Permission.objects.filter(
+                get_multi_crud_query(roles, agents, chunk)
+            ))
+
+            removed += count
+            target_models |= models
+
+    if removed:
+        _perms_changed(roles, agents, targets, target_models)
+
+    return removed
@@ -0,0 +1,20 @@
+from django.dispatch import Signal
+
+"""
+Sent by the shortcuts whenever Permission rows are written. Each of roles,
+agents and targets is either a list of concrete values or ANY/NULL, exactly
+as it was used to filter the rows that were touched. target_models, when
+known, is the set of models whose objects were the targets of those rows;
+it is None otherwise.
+"""
+permissions_changed = Signal(
+    providing_args=['roles', 'agents', 'targets', 'target_models']
+)
+
+"""
+Sent after each instrumented permission call when anything is listening.
+phase names the call, duration is in seconds, and queries is the number
+of SQL statements it ran, or None if queries aren't being logged. Calls
+may add further details such as prefixes or agents.
+"""
+permission_timing = Signal(providing_args=['phase', 'duration', 'queries'])
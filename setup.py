@@ -12,6 +12,8 @@ setup(
     version='1.0.3',
     packages=[
         'flexible_permissions',
+        'flexible_permissions.management',
+        'flexible_permissions.management.commands',
         'flexible_permissions.migrations',
     ],
     include_package_data=True,
@@ -6,6 +6,22 @@ from flexible_permissions.relations import register_relation
 from tests.models import User, Group, Zoo, Exhibit, Animal
 
 
+def get_users_groups(users):
+    """
+    Gets every user's groups in one query.
+    """
+    Membership = Group.user_set.through
+    memberships = Membership.objects.filter(
+        user__in=[user.pk for user in users]
+    ).select_related('group')
+
+    result = dict((user.pk, [user]) for user in users)
+    for membership in memberships:
+        result[membership.user_id].append(membership.group)
+
+    return dict((user, result[user.pk]) for user in users)
+
+
 class TestsConfig(AppConfig):
     name = 'tests'
     verbose_name = "Tests"
@@ -43,5 +59,10 @@ class TestsConfig(AppConfig):
         Register Agents
         """
 
-        register_agent(User, lambda user: [user] + list(user.group_set.all()))
+        register_agent(
+            User,
+            lambda user: [user] + list(user.group_set.all()),
+            batch_fn=get_users_groups,
+            paths=['group']
+        )
         register_agent(Group, lambda group: [group])
@@ -10,6 +10,12 @@ class User(PermAgent):
 class Group(PermAgent, PermTarget):
     name = models.CharField(max_length=255)
     user_set = models.ManyToManyField(User)
+    parent = models.ForeignKey(
+        'self',
+        related_name='children',
+        null=True,
+        blank=True
+    )
 
 
 class Zoo(PermTarget):
@@ -1,7 +1,9 @@
 from django.test import TestCase
-from flexible_permissions.agents import normalize_agent
+from flexible_permissions.agents import normalize_agent, register_agent
+from flexible_permissions.cache import permission_cache
 from flexible_permissions.shortcuts import NULL
 
+from tests.apps import get_users_groups
 from tests.models import User, Group, Exhibit
 from tests.utils import create_test_models
 
@@ -32,3 +34,41 @@ class AgentsTestCase(TestCase):
     def test_null_agent(self):
         results = Exhibit.objects.for_action('visit', NULL)
         self.assertEqual(2, results.count())
+
+    def test_batch(self):
+        users = list(User.objects.all())
+        group = Group.objects.first()
+
+        # One query for all users' groups
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                set(users + [group]),
+                set(normalize_agent(users))
+            )
+
+        # Without a batch function, it's one query per user
+        register_agent(User, lambda user: [user] + list(user.group_set.all()))
+        try:
+            with self.assertNumQueries(len(users)):
+                normalize_agent(users)
+        finally:
+            register_agent(
+                User,
+                lambda user: [user] + list(user.group_set.all()),
+                batch_fn=get_users_groups,
+                paths=['group']
+            )
+
+    def test_memoized(self):
+        user = User.objects.get(name='staff user')
+        users = list(User.objects.all())
+
+        with permission_cache():
+            normalize_agent(user)
+
+            with self.assertNumQueries(0):
+                normalize_agent(user)
+
+            # Only new agents are expanded
+            with self.assertNumQueries(1):
+                normalize_agent(users)
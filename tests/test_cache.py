@@ -0,0 +1,248 @@
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from flexible_permissions import cache as shared_cache
+from flexible_permissions.cache import (
+    PermissionCacheMiddleware,
+    get_generation_names,
+    get_generations,
+    get_request_cache,
+    permission_cache,
+)
+from flexible_permissions.shortcuts import (
+    ANY,
+    NULL,
+    add_perm,
+    bulk_add_perms,
+    has_perm,
+    remove_perm,
+)
+
+from tests.models import User, Zoo, Exhibit, Animal
+from tests.utils import create_test_models
+
+
+class RequestCacheTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+
+    def test_scope(self):
+        self.assertIsNone(get_request_cache('targets'))
+
+        with permission_cache():
+            self.assertEqual({}, get_request_cache('targets'))
+
+            # Nested scopes share the outer cache
+            get_request_cache('targets')['key'] = 'value'
+            with permission_cache():
+                self.assertIn('key', get_request_cache('targets'))
+
+            self.assertIn('key', get_request_cache('targets'))
+
+        self.assertIsNone(get_request_cache('targets'))
+
+    def test_middleware(self):
+        middleware = PermissionCacheMiddleware()
+
+        middleware.process_request(None)
+        self.assertIsNotNone(get_request_cache('targets'))
+
+        middleware.process_response(None, 'response')
+        self.assertIsNone(get_request_cache('targets'))
+
+    def test_memoizes(self):
+        user = User.objects.get(name='staff user')
+
+        with permission_cache():
+            self.assertEqual(
+                2,
+                Animal.objects.for_action('feed', user).count()
+            )
+
+            # Agent expansion and prefix resolution are skipped entirely
+            with self.assertNumQueries(1):
+                results = Animal.objects.for_action('feed', user)
+                self.assertEqual(2, results.count())
+
+            # The cached ids still respect the queryset's own filters
+            exhibit = Exhibit.objects.first()
+            results = Animal.objects.filter(exhibit=exhibit)
+            self.assertEqual(2, results.for_action('feed', user).count())
+
+    def test_invalidation(self):
+        admin = User.objects.get(name='admin user')
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+
+        with permission_cache():
+            self.assertEqual(
+                0,
+                Zoo.objects.for_role('zoo.admin', visitor).count()
+            )
+            self.assertEqual(
+                1,
+                Zoo.objects.for_role('zoo.admin', admin).count()
+            )
+
+            add_perm('zoo.admin', visitor, zoo)
+            cache = get_request_cache('targets')
+            self.assertEqual(1, len(cache))
+            self.assertEqual(
+                1,
+                Zoo.objects.for_role('zoo.admin', visitor).count()
+            )
+
+            remove_perm('zoo.admin', ANY, zoo)
+            self.assertEqual(0, len(cache))
+            self.assertEqual(
+                0,
+                Zoo.objects.for_role('zoo.admin', admin).count()
+            )
+
+    def test_related_changes(self):
+        staff = User.objects.get(name='staff user')
+        exhibit = Exhibit.objects.order_by('pk').first()
+
+        with permission_cache():
+            self.assertEqual(
+                2,
+                Animal.objects.for_action('feed', staff).count()
+            )
+            self.assertEqual(1, Zoo.objects.for_action('visit', staff).count())
+
+            # Only entries for models along the saved model's paths go
+            animal = Animal.objects.create(exhibit=exhibit)
+            self.assertEqual(1, len(get_request_cache('targets')))
+            self.assertTrue(has_perm(staff, 'feed', animal))
+            self.assertEqual(
+                3,
+                Animal.objects.for_action('feed', staff).count()
+            )
+
+            animal.delete()
+            self.assertEqual(
+                2,
+                Animal.objects.for_action('feed', staff).count()
+            )
+
+
+@override_settings(
+    CACHES={
+        'permissions': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    },
+    FLEXIBLE_PERMISSIONS_CACHE='permissions'
+)
+class SharedCacheTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+        caches['permissions'].clear()
+
+    def test_get_generation_names(self):
+        user = User.objects.get(name='staff user')
+        zoo = Zoo.objects.first()
+
+        self.assertEqual(['all'], get_generation_names())
+        self.assertEqual(
+            ['agent:any', 'agent:null', 'agent:tests.user:%s' % user.pk],
+            get_generation_names(agent=[user])
+        )
+        self.assertEqual(
+            ['target:any', 'target:tests.zoo'],
+            get_generation_names(target=[zoo])
+        )
+        self.assertEqual(
+            ['all', 'model:tests.zoo'],
+            get_generation_names(models=[Zoo])
+        )
+
+    def test_memoizes(self):
+        user = User.objects.get(name='staff user')
+        self.assertEqual(2, Animal.objects.for_action('feed', user).count())
+
+        # Only agent expansion and the final fetch hit the database
+        with self.assertNumQueries(2):
+            results = Animal.objects.for_action('feed', user)
+            self.assertEqual(2, results.count())
+
+    def test_invalidation(self):
+        staff = User.objects.get(name='staff user')
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+
+        self.assertEqual(0, Zoo.objects.for_role('zoo.admin', visitor).count())
+        self.assertEqual(1, User.objects.with_role('zoo.admin', zoo).count())
+
+        add_perm('zoo.admin', visitor, zoo)
+        self.assertEqual(1, Zoo.objects.for_role('zoo.admin', visitor).count())
+        self.assertEqual(2, User.objects.with_role('zoo.admin', zoo).count())
+
+        # Public permissions apply to every agent
+        self.assertEqual(0, Zoo.objects.for_role('zoo.admin', staff).count())
+        add_perm('zoo.admin', NULL, zoo)
+        self.assertEqual(1, Zoo.objects.for_role('zoo.admin', staff).count())
+
+        remove_perm('zoo.admin', ANY, ANY)
+        self.assertEqual(0, Zoo.objects.for_role('zoo.admin', visitor).count())
+        self.assertEqual(0, User.objects.with_role('zoo.admin', zoo).count())
+
+    def test_related_changes(self):
+        staff = User.objects.get(name='staff user')
+        exhibit = Exhibit.objects.order_by('pk').first()
+        other_exhibit = Exhibit.objects.order_by('pk').last()
+        self.assertEqual(2, Animal.objects.for_action('feed', staff).count())
+
+        # New objects reached through relations show up
+        animal = Animal.objects.create(exhibit=exhibit)
+        self.assertEqual(3, Animal.objects.for_action('feed', staff).count())
+
+        animal.exhibit = other_exhibit
+        animal.save()
+        self.assertEqual(2, Animal.objects.for_action('feed', staff).count())
+
+        # So do changes further along the path
+        zoo = Zoo.objects.create()
+        other_exhibit.zoo = zoo
+        other_exhibit.save()
+        add_perm('zoo.admin', staff, zoo)
+        self.assertEqual(5, Animal.objects.for_action('feed', staff).count())
+
+    @override_settings(FLEXIBLE_PERMISSIONS_CACHE_MAX_IDS=1)
+    def test_too_many_ids(self):
+        user = User.objects.get(name='staff user')
+        self.assertEqual(2, Animal.objects.for_action('feed', user).count())
+
+        # Too many to store, so the query runs again without an IN list
+        with self.assertNumQueries(2):
+            results = Animal.objects.for_action('feed', user)
+            self.assertEqual(2, results.count())
+
+    def test_bulk_generations(self):
+        users = list(User.objects.all())
+        exhibits = list(Exhibit.objects.all())
+        names = ['agent:any', 'target:tests.exhibit']
+
+        def get_changed(fn):
+            before = get_generations(caches['permissions'], names)
+            fn()
+            after = get_generations(caches['permissions'], names)
+
+            return [
+                name for name, old, new in zip(names, before, after)
+                if old != new
+            ]
+
+        # Targets are bumped once per model
+        self.assertEqual(['target:tests.exhibit'], get_changed(
+            lambda: bulk_add_perms('exhibit.staff', users[:1], exhibits)
+        ))
+
+        # And many agents at once bump agent:any
+        max_agents = shared_cache.MAX_AGENT_GENERATIONS
+        try:
+            shared_cache.MAX_AGENT_GENERATIONS = 1
+            self.assertEqual(names, get_changed(
+                lambda: bulk_add_perms('exhibit.staff', users, exhibits)
+            ))
+        finally:
+            shared_cache.MAX_AGENT_GENERATIONS = max_agents
@@ -0,0 +1,70 @@
+from django.test import TestCase
+from flexible_permissions.changes import (
+    ADD,
+    REMOVE,
+    changes_since,
+    get_last_seq,
+)
+from flexible_permissions.shortcuts import (
+    ANY,
+    add_perm,
+    assign_role,
+    bulk_add_perms,
+    bulk_remove_perms,
+    remove_perm,
+)
+
+from tests.models import User, Zoo, Exhibit
+from tests.utils import create_test_models
+
+
+class ChangesTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+
+    def get_changes(self, seq):
+        return [
+            (change.op, change.role, change.agent_id)
+            for change in changes_since(seq)
+        ]
+
+    def test_changes_since(self):
+        admin = User.objects.get(name='admin user')
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+        exhibits = Exhibit.objects.all()
+
+        seq = get_last_seq()
+
+        add_perm('zoo.admin', visitor, zoo)
+        add_perm('zoo.admin', visitor, zoo)
+        assign_role('zoo.visitor', admin, zoo)
+        remove_perm('zoo.admin', visitor, zoo)
+
+        self.assertEqual([
+            (ADD, 'zoo.admin', visitor.pk),
+            (REMOVE, 'zoo.visitor', None),
+            (ADD, 'zoo.visitor', admin.pk),
+            (REMOVE, 'zoo.admin', visitor.pk),
+        ], self.get_changes(seq))
+
+        seq = get_last_seq()
+
+        bulk_add_perms('exhibit.staff', [admin], exhibits)
+        bulk_remove_perms('exhibit.staff', [admin], ANY)
+
+        self.assertEqual(
+            [(ADD, 'exhibit.staff', admin.pk)] * 2 +
+            [(REMOVE, 'exhibit.staff', admin.pk)] * 2,
+            self.get_changes(seq)
+        )
+
+        # Entries are read in order, limit at a time
+        changes = list(changes_since(seq, limit=3, chunk_size=2))
+        self.assertEqual(3, len(changes))
+        self.assertEqual(
+            sorted(change.seq for change in changes),
+            [change.seq for change in changes]
+        )
+
+        self.assertEqual([], self.get_changes(get_last_seq()))
@@ -0,0 +1,139 @@
+from django.core.management import call_command
+from django.db.models.signals import post_save, post_delete
+from django.test import TestCase, override_settings
+from flexible_permissions.effective import (
+    get_dependents,
+    get_effective_perms,
+    rebuild,
+)
+from flexible_permissions.models import EffectivePermission, Permission
+from flexible_permissions.shortcuts import (
+    ANY,
+    NULL,
+    add_perm,
+    remove_perm,
+    transfer_perms,
+)
+from flexible_permissions._utils import get_content_type_id
+
+from tests.models import User, Zoo, Exhibit, Animal
+from tests.utils import create_test_models
+
+
+@override_settings(FLEXIBLE_PERMISSIONS_EFFECTIVE=True)
+class EffectivePermissionTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+        rebuild()
+
+    def test_get_effective_perms(self):
+        animal = Animal.objects.filter(exhibit=Exhibit.objects.first())[0]
+        actions = set(
+            perm.action for perm in get_effective_perms(Animal, [animal.pk])
+        )
+
+        self.assertEqual(set(['animal.feed', 'animal.see']), actions)
+
+    def test_get_dependents(self):
+        zoo = Zoo.objects.first()
+        dependents = dict(
+            (model, set(pks))
+            for model, pks in get_dependents(Zoo, [zoo.pk])
+        )
+
+        self.assertEqual(set([zoo.pk]), dependents[Zoo])
+        self.assertEqual(4, len(dependents[Animal]))
+        self.assertEqual(2, len(dependents[Exhibit]))
+
+    def test_for_action(self):
+        user = User.objects.get(name='staff user')
+        admin = User.objects.get(name='admin user')
+
+        # One query for the groups, one for the lookup
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                2,
+                Animal.objects.for_action('feed', user).count()
+            )
+
+        self.assertEqual(4, Animal.objects.for_action('feed', admin).count())
+        self.assertEqual(4, Animal.objects.for_action('see', user).count())
+        self.assertEqual(4, Animal.objects.for_action('feed').count())
+        self.assertEqual(0, Animal.objects.for_action('feed', NULL).count())
+
+    def test_sync_permissions(self):
+        visitor = User.objects.get(name='visiting user')
+        exhibit = Exhibit.objects.last()
+
+        add_perm('exhibit.staff', visitor, exhibit)
+        self.assertEqual(2, Animal.objects.for_action('feed', visitor).count())
+
+        remove_perm('exhibit.staff', ANY, ANY)
+        self.assertEqual(0, Animal.objects.for_action('feed', visitor).count())
+
+    def test_sync_touched_targets(self):
+        staff = User.objects.get(name='staff user')
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+
+        def get_zoo_rows():
+            return set(
+                EffectivePermission.objects
+                .filter(target_type_id=get_content_type_id(Zoo))
+                .values_list('pk', flat=True)
+            )
+
+        # Only the exhibits and animals written to are refreshed, rather
+        # than everything being rebuilt
+        zoo_rows = get_zoo_rows()
+        remove_perm('exhibit.staff', ANY, ANY)
+        self.assertEqual(zoo_rows, get_zoo_rows())
+        self.assertEqual(0, Animal.objects.for_action('feed', staff).count())
+
+        add_perm('exhibit.staff', staff, Exhibit.objects.first())
+        zoo_rows = get_zoo_rows()
+        transfer_perms(staff, visitor)
+        self.assertEqual(zoo_rows, get_zoo_rows())
+        self.assertEqual(2, Animal.objects.for_action('feed', visitor).count())
+
+        # Writes on zoos still refresh them
+        remove_perm('zoo.admin', ANY, ANY)
+        self.assertNotEqual(zoo_rows, get_zoo_rows())
+        self.assertEqual(0, Zoo.objects.for_action('open').count())
+        self.assertEqual(1, Zoo.objects.for_action('visit').count())
+        self.assertEqual(zoo.pk, Zoo.objects.for_action('visit')[0].pk)
+
+    def test_sync_relations(self):
+        user = User.objects.get(name='staff user')
+        exhibits = Exhibit.objects.order_by('pk')
+
+        animal = Animal.objects.create(exhibit=exhibits[0])
+        self.assertEqual(3, Animal.objects.for_action('feed', user).count())
+
+        animal.exhibit = exhibits[1]
+        animal.save()
+        self.assertEqual(2, Animal.objects.for_action('feed', user).count())
+
+        animal.exhibit = exhibits[0]
+        animal.save()
+        animal.delete()
+        self.assertEqual(2, Animal.objects.for_action('feed', user).count())
+        self.assertFalse(
+            EffectivePermission.objects.filter(target_id=animal.pk).exists()
+        )
+
+    def test_receivers(self):
+        # Models that don't take part in relations keep fast deletes
+        self.assertFalse(post_delete.has_listeners(Permission))
+        self.assertFalse(post_save.has_listeners(Permission))
+        self.assertFalse(post_delete.has_listeners(EffectivePermission))
+        self.assertTrue(post_delete.has_listeners(Zoo))
+        self.assertTrue(post_save.has_listeners(Exhibit))
+
+    def test_command(self):
+        EffectivePermission.objects.all().delete()
+        call_command('rebuild_effective_permissions', batch_size=1)
+
+        # Public visitor actions on the zoo, its exhibits and animals, the
+        # admin's actions on all of them, and staff on one exhibit
+        self.assertEqual(7 + 16 + 6, EffectivePermission.objects.count())
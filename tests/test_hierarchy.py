@@ -0,0 +1,123 @@
+from django.test import TestCase
+from flexible_permissions.agents import normalize_agent, register_agent
+from flexible_permissions.hierarchy import (
+    _parent_registry,
+    get_ancestors,
+    rebuild_closure,
+)
+from flexible_permissions.models import AgentClosure
+from flexible_permissions.shortcuts import add_perm
+
+from tests.models import User, Group, Zoo
+from tests.utils import create_test_models
+
+
+class HierarchyTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+
+        register_agent(Group, lambda group: [group], parent='parent')
+        rebuild_closure()
+
+        self.staff = Group.objects.get(name='staff')
+        self.department = Group.objects.create(name='department')
+        self.org = Group.objects.create(name='org')
+
+        self.department.parent = self.org
+        self.department.save()
+
+        self.staff.parent = self.department
+        self.staff.save()
+
+    def tearDown(self):
+        _parent_registry.pop(Group)
+
+    def get_ancestor_names(self, group):
+        ancestors = get_ancestors([group]).get((Group, group.pk), [])
+        return set(
+            Group.objects
+            .filter(pk__in=[ancestor.pk for ancestor in ancestors])
+            .values_list('name', flat=True)
+        )
+
+    def test_get_ancestors(self):
+        self.assertEqual(
+            set(['department', 'org']),
+            self.get_ancestor_names(self.staff)
+        )
+        self.assertEqual(
+            set(['org']),
+            self.get_ancestor_names(self.department)
+        )
+        self.assertEqual(set(), self.get_ancestor_names(self.org))
+
+        # One query however deep the hierarchy
+        with self.assertNumQueries(1):
+            get_ancestors([self.staff])
+
+    def test_move(self):
+        with self.assertRaises(ValueError):
+            self.org.parent = self.staff
+            self.org.save()
+
+        # Nothing was written
+        self.assertIsNone(Group.objects.get(pk=self.org.pk).parent_id)
+        self.assertEqual(set(), self.get_ancestor_names(self.org))
+
+        with self.assertRaises(ValueError):
+            self.org.parent = self.org
+            self.org.save()
+
+        self.org.parent = None
+
+        # Moving a group moves everything below it
+        self.department.parent = None
+        self.department.save()
+        self.assertEqual(
+            set(['department']),
+            self.get_ancestor_names(self.staff)
+        )
+
+
+    def test_delete(self):
+        self.department.delete()
+        self.assertFalse(AgentClosure.objects.filter(
+            ancestor_id=self.org.pk,
+            depth__gt=0
+        ).exists())
+
+    def test_rebuild(self):
+        rows = set(AgentClosure.objects.values_list(
+            'ancestor_id',
+            'descendant_id',
+            'depth'
+        ))
+
+        AgentClosure.objects.all().delete()
+        rebuild_closure()
+
+        self.assertEqual(rows, set(AgentClosure.objects.values_list(
+            'ancestor_id',
+            'descendant_id',
+            'depth'
+        )))
+
+    def test_normalize_agent(self):
+        user = User.objects.get(name='staff user')
+
+        self.assertEqual(
+            set([user.pk, self.staff.pk, self.department.pk, self.org.pk]),
+            set(agent.pk for agent in normalize_agent(user))
+        )
+
+        # Permissions granted to ancestors apply
+        zoo = Zoo.objects.first()
+        add_perm('zoo.admin', self.org, zoo)
+        self.assertEqual(1, Zoo.objects.for_action('open', user).count())
+
+        # And are found from the target
+        self.assertIn(user, User.objects.with_action('zoo.open', zoo))
+        self.assertEqual(
+            set([self.staff, self.department, self.org]),
+            set(Group.objects.with_action('zoo.open', zoo))
+        )
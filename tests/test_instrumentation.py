@@ -0,0 +1,99 @@
+from django.test import TestCase
+from flexible_permissions.instrumentation import (
+    PermissionTimingCollector,
+    annotate,
+    instrument,
+)
+from flexible_permissions.shortcuts import add_perm
+from flexible_permissions.signals import permission_timing
+
+from tests.models import User, Zoo, Animal
+from tests.utils import create_test_models
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+
+    def test_instrument(self):
+        calls = []
+
+        def receiver(sender, **call):
+            calls.append(call)
+
+        # Nothing is sent without listeners
+        with instrument('phase', detail=1):
+            annotate(other=2)
+
+        permission_timing.connect(receiver)
+        try:
+            with instrument('phase', detail=1):
+                annotate(other=2)
+        finally:
+            permission_timing.disconnect(receiver)
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual('phase', calls[0]['phase'])
+        self.assertEqual(1, calls[0]['detail'])
+        self.assertEqual(2, calls[0]['other'])
+        self.assertIn('duration', calls[0])
+        self.assertIn('queries', calls[0])
+
+    def test_collector(self):
+        user = User.objects.get(name='staff user')
+
+        with PermissionTimingCollector() as collector:
+            list(Animal.objects.for_action('feed', user))
+            add_perm('zoo.admin', user, Zoo.objects.first())
+
+        self.assertEqual(
+            set([
+                'actions_to_roles',
+                'normalize_agent',
+                'query_perms',
+                'add_perm',
+            ]),
+            set(collector.phases)
+        )
+
+        # Group expansion is one query, and the user is in one group
+        self.assertEqual(1, collector.phases['normalize_agent']['queries'])
+
+        query_perms = [
+            call for call in collector.calls
+            if call['phase'] == 'query_perms'
+        ][0]
+        self.assertEqual(3, query_perms['prefixes'])
+        self.assertEqual(2, query_perms['agents'])
+
+        # Nothing is collected once stopped
+        list(Animal.objects.for_action('feed', user))
+        self.assertEqual(1, collector.phases['query_perms']['calls'])
+
+        # Nor timed, once no collector is left
+        self.assertFalse(permission_timing.receivers)
+
+        with PermissionTimingCollector() as outer:
+            with PermissionTimingCollector():
+                pass
+
+            self.assertTrue(permission_timing.receivers)
+            list(Animal.objects.for_action('feed', user))
+
+        self.assertEqual(1, outer.phases['query_perms']['calls'])
+        self.assertFalse(permission_timing.receivers)
+
+    def test_collector_slowest(self):
+        collector = PermissionTimingCollector(slowest=2)
+
+        for duration in [1, 3, 2]:
+            collector.add({'phase': 'x', 'duration': duration, 'queries': 1})
+
+        self.assertEqual(
+            [3,
+            2], [call['duration'] for call in collector.calls]
+        )
+        self.assertEqual(
+            {'calls': 3, 'duration': 6, 'queries': 3},
+            collector.phases['x']
+        )
@@ -0,0 +1,160 @@
+from django.test import TestCase
+from flexible_permissions.memory import MemoryEngine
+from flexible_permissions.models import PermissionChange
+from flexible_permissions.relations import (
+    _relation_registry,
+    register_relation,
+)
+from flexible_permissions.shortcuts import (
+    ANY,
+    NULL,
+    add_perm,
+    has_perm,
+    remove_perm,
+)
+
+from tests.models import User, Zoo, Exhibit, Animal
+from tests.utils import create_test_models
+
+
+class MemoryEngineTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+
+        self.engine = MemoryEngine()
+
+    def tearDown(self):
+        self.engine.close()
+
+    def get_ids(self, queryset):
+        return set(queryset.values_list('pk', flat=True))
+
+    def test_for_action(self):
+        users = list(User.objects.all())
+
+        for model, action in [
+            (Zoo, 'open'),
+            (Exhibit, 'clean'),
+            (Animal, 'feed'),
+            (Animal, 'see'),
+        ]:
+            for agent in users + [ANY]:
+                self.assertEqual(
+                    self.get_ids(model.objects.for_action(action, agent)),
+                    self.engine.for_action(model, action, agent)
+                )
+
+        # Nothing is loaded again
+        user = User.objects.get(name='staff user')
+        self.engine.for_action(Animal, 'feed', user)
+
+        with self.assertNumQueries(1):
+            self.engine.for_action(Animal, 'feed', user)
+
+    def test_has_perm(self):
+        users = list(User.objects.all())
+
+        for animal in Animal.objects.all():
+            for user in users:
+                for action in ['feed', 'see']:
+                    self.assertEqual(
+                        has_perm(user, action, animal),
+                        self.engine.has_perm(user, action, animal)
+                    )
+
+    def test_multi_valued_paths(self):
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.create()
+        other_zoo = Zoo.objects.create()
+        exhibits = [Exhibit.objects.create(zoo=zoo) for i in range(2)]
+        add_perm('exhibit.staff', visitor, exhibits[0])
+
+        register_relation(Zoo, {'exhibit': 'exhibit'})
+        engine = MemoryEngine()
+        try:
+            self.assertEqual(
+                self.get_ids(Zoo.objects.for_action('visit', visitor)),
+                engine.for_action(Zoo, 'visit', visitor)
+            )
+            self.assertTrue(engine.has_perm(visitor, 'visit', zoo))
+            self.assertFalse(engine.has_perm(visitor, 'visit', other_zoo))
+
+            # The links are on the exhibits' rows
+            exhibits[0].zoo = other_zoo
+            exhibits[0].save()
+            self.assertFalse(engine.has_perm(visitor, 'visit', zoo))
+            self.assertTrue(engine.has_perm(visitor, 'visit', other_zoo))
+        finally:
+            engine.close()
+            register_relation(Zoo, {})
+            del _relation_registry[Zoo]
+
+    def test_with_role(self):
+        zoo = Zoo.objects.first()
+
+        self.assertEqual(
+            self.get_ids(User.objects.with_role(ANY, zoo)),
+            self.engine.with_role(User, ANY, zoo)
+        )
+        self.assertEqual(
+            self.get_ids(User.objects.with_action('zoo.open')),
+            self.engine.with_action(User, 'zoo.open')
+        )
+
+    def test_sync(self):
+        visitor = User.objects.get(name='visiting user')
+        exhibits = Exhibit.objects.order_by('pk')
+        animal = Animal.objects.filter(exhibit=exhibits[1]).first()
+
+        self.assertFalse(self.engine.has_perm(visitor, 'feed', animal))
+
+        add_perm('exhibit.staff', visitor, exhibits[1])
+        self.assertTrue(self.engine.has_perm(visitor, 'feed', animal))
+
+        # Moving an object moves its edges
+        animal.exhibit = exhibits[0]
+        animal.save()
+        self.assertFalse(self.engine.has_perm(visitor, 'feed', animal))
+
+        animal.exhibit = exhibits[1]
+        animal.save()
+        remove_perm('exhibit.staff', visitor, exhibits[1])
+        self.assertFalse(self.engine.has_perm(visitor, 'feed', animal))
+
+    def test_changes(self):
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+
+        # As if another process made the changes
+        self.engine.close()
+
+        add_perm('zoo.admin', visitor, zoo)
+        remove_perm('zoo.visitor', ANY, zoo)
+        self.assertFalse(self.engine.has_perm(visitor, 'open', zoo))
+
+        self.assertEqual(1, self.engine.sync(limit=1))
+        self.assertTrue(self.engine.has_perm(visitor, 'open', zoo))
+        self.assertTrue(self.engine.has_perm(NULL, 'visit', zoo))
+
+        self.assertEqual(1, self.engine.sync())
+        self.assertFalse(self.engine.has_perm(NULL, 'visit', zoo))
+        self.assertEqual(0, self.engine.sync())
+
+    def test_late_changes(self):
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+        self.engine.close()
+
+        # A change whose transaction commits after a later one's
+        add_perm('zoo.admin', visitor, zoo)
+        late = PermissionChange.objects.latest('seq')
+        late.delete()
+
+        add_perm('zoo.visitor', visitor, zoo)
+        self.assertEqual(1, self.engine.sync())
+        self.assertFalse(self.engine.has_perm(visitor, 'open', zoo))
+
+        late.save()
+        self.assertEqual(1, self.engine.sync())
+        self.assertTrue(self.engine.has_perm(visitor, 'open', zoo))
+        self.assertEqual(0, self.engine.sync())
@@ -1,6 +1,18 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+from flexible_permissions.models import Permission
+from flexible_permissions.query import TOGETHER, SEPARATE, UNION, SUBQUERY
+from flexible_permissions.shortcuts import (
+    ANY,
+    add_perm,
+    get_perms,
+    has_perms,
+)
+from flexible_permissions._utils import get_role_id
 
-from tests.models import User, Zoo, Exhibit
+from tests.models import User, Group, Zoo, Exhibit, Animal
 from tests.utils import create_test_models
 
 
@@ -57,6 +69,112 @@ class TargetTestCase(TestCase):
         results = Zoo.objects.for_action('open', admin)
         self.assertEqual(1, results.count())
 
+    def test_strategies(self):
+        staff = User.objects.get(name='staff user')
+        exhibit = Exhibit.objects.first()
+
+        def get_ids(results):
+            # Joining several prefixes together can repeat rows
+            return set(results.values_list('pk', flat=True))
+
+        for strategy in [TOGETHER, SEPARATE, UNION, SUBQUERY]:
+            results = Animal.objects.for_action('feed', strategy=strategy)
+            self.assertEqual(4, len(get_ids(results)))
+
+            results = Animal.objects.for_action(
+                'feed',
+                staff,
+                strategy=strategy
+            )
+            self.assertEqual(2, len(get_ids(results)))
+
+            # The queryset's own filters still apply
+            results = Animal.objects.exclude(exhibit=exhibit).for_action(
+                'feed',
+                staff,
+                strategy=strategy
+            )
+            self.assertEqual(0, len(get_ids(results)))
+
+        # Multiple prefixes don't need ids to be fetched first
+        with self.assertNumQueries(1):
+            list(Animal.objects.for_action('feed', staff, infer_agents=False))
+
+    def test_iter_for_action(self):
+        staff = User.objects.get(name='staff user')
+        animals = Animal.objects.for_action('see', staff).order_by('pk')
+
+        for strategy in [TOGETHER, SEPARATE, UNION, SUBQUERY]:
+            results = Animal.objects.iter_for_action(
+                'see',
+                staff,
+                strategy=strategy,
+                chunk_size=3
+            )
+            self.assertEqual(list(animals), list(results))
+
+        # One query for the groups and one per chunk
+        with self.assertNumQueries(3):
+            list(Animal.objects.iter_for_action('see', staff, chunk_size=3))
+
+        # Even SEPARATE or the shared cache doesn't fetch every id first
+        with self.settings(
+            CACHES={
+                'permissions': {
+                    'BACKEND': 'django.core.cache.backends.locmem.'
+                    'LocMemCache',
+                }
+            },
+            FLEXIBLE_PERMISSIONS_CACHE='permissions'
+        ):
+            with self.assertNumQueries(3):
+                list(Animal.objects.iter_for_action(
+                    'see',
+                    staff,
+                    strategy=SEPARATE,
+                    chunk_size=3
+                ))
+
+    def test_with_allowed_actions(self):
+        staff = User.objects.get(name='staff user')
+        exhibit = Exhibit.objects.order_by('pk').first()
+
+        with self.assertRaises(ValueError):
+            Animal.objects.with_allowed_actions(staff, ['animal.feed'])
+
+        # One query for the animals, one for the groups, one for relations
+        # and one for the permissions
+        with self.assertNumQueries(4):
+            animals = list(
+                Animal.objects.filter(pk__isnull=False)
+                .with_allowed_actions(staff)
+                .order_by('pk')
+            )
+
+        for animal in animals:
+            self.assertEqual(
+                set(['feed', 'see'])
+                if animal.exhibit_id == exhibit.pk else
+                set(['see']),
+                animal.allowed_actions
+            )
+
+        animals = Animal.objects.with_allowed_actions(
+            staff,
+            'feed',
+            attr='actions'
+        )
+        self.assertEqual(
+            [animal.exhibit_id == exhibit.pk for animal in animals],
+            ['feed' in animal.actions for animal in animals]
+        )
+
+        # Only objects are annotated
+        self.assertEqual(
+            4,
+            len(Animal.objects.with_allowed_actions(staff).values('pk'))
+        )
+
 
 class AgentTestCase(TestCase):
     def setUp(self):
@@ -87,9 +205,9 @@ class AgentTestCase(TestCase):
         results = User.objects.with_role(target=zoo)
         self.assertEqual(1, results.count())
 
-        # Relational permission queries don't work
-        with self.assertRaises(ValueError):
-            User.objects.with_role('zoo.admin', exhibit)
+        # Roles on related objects count
+        results = User.objects.with_role('zoo.admin', exhibit)
+        self.assertEqual([admin], list(results))
 
         # Invalid role
         with self.assertRaises(ValueError):
@@ -109,3 +227,129 @@ class AgentTestCase(TestCase):
 
         results = User.objects.with_action('zoo.open', zoo)
         self.assertEqual(1, results.count())
+
+    def test_action_related(self):
+        exhibits = Exhibit.objects.order_by('pk')
+        animal = Animal.objects.filter(exhibit=exhibits[0]).first()
+        other_animal = Animal.objects.filter(exhibit=exhibits[1]).first()
+
+        # Through zoo.admin on the zoo, and the staff group's exhibit.staff
+        # on the exhibit
+        self.assertEqual(
+            set(['admin user', 'staff user']),
+            set(
+                User.objects.with_action('animal.feed', animal)
+                .values_list('name', flat=True)
+            )
+        )
+        self.assertEqual(
+            ['admin user'],
+            list(
+                User.objects.with_action('animal.feed', other_animal)
+                .values_list('name', flat=True)
+            )
+        )
+        self.assertEqual(
+            ['staff'],
+            list(
+                Group.objects.with_action('animal.feed', animal)
+                .values_list('name', flat=True)
+            )
+        )
+
+        # Roles that can't apply to the target are ignored
+        self.assertEqual(
+            ['admin user'],
+            list(
+                User.objects.with_action('animal.feed', exhibits[0].zoo)
+                .values_list('name', flat=True)
+            )
+        )
+
+        # One query for relations, then the grants stay in subqueries
+        with self.assertNumQueries(2):
+            list(User.objects.with_action('animal.feed', [animal]))
+
+        # Every strategy finds the same agents
+        for strategy in [TOGETHER, SEPARATE, UNION, SUBQUERY]:
+            results = User.objects.with_role(
+                ['zoo.admin', 'exhibit.staff'],
+                animal,
+                strategy=strategy
+            )
+            self.assertEqual(
+                ['admin user', 'staff user'],
+                sorted(results.values_list('name', flat=True))
+            )
+
+
+class RoleIdsTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+
+    def get_results(self):
+        staff = User.objects.get(name='staff user')
+        zoo = Zoo.objects.first()
+        animals = Animal.objects.order_by('pk')
+
+        return [
+            list(Animal.objects.for_action('feed', staff).order_by('pk')),
+            list(Exhibit.objects.for_action('visit', staff).order_by('pk')),
+            list(User.objects.with_role('zoo.admin', zoo)),
+            list(User.objects.with_action('animal.feed', animals[0])),
+            has_perms(staff, 'feed', animals),
+            list(get_perms('zoo.admin', ANY, ANY)),
+        ]
+
+    def test_role_ids(self):
+        expected = self.get_results()
+
+        with override_settings(FLEXIBLE_PERMISSIONS_ROLE_IDS=True):
+            self.assertEqual(expected, self.get_results())
+
+            # Writes fill in role ids
+            visitor = User.objects.get(name='visiting user')
+            zoo = Zoo.objects.first()
+
+            add_perm('zoo.admin', visitor, zoo)
+            self.assertEqual(
+                2,
+                User.objects.with_action('zoo.open', zoo).count()
+            )
+
+            self.assertIn(
+                'role_id',
+                str(Zoo.objects.for_action('open', visitor).query)
+            )
+
+    def test_writes(self):
+        # The test models are inserted with bulk_create
+        for perm in Permission.objects.all():
+            self.assertEqual(get_role_id(perm.role), perm.role_id)
+
+        Permission.objects.filter(role='zoo.admin').update(role='zoo.visitor')
+        self.assertEqual(
+            set([get_role_id('zoo.visitor')]),
+            set(Permission.objects.filter(role='zoo.visitor').values_list(
+                'role_id', flat=True
+            ))
+        )
+
+        # Expressions can't be hashed, so role_id has to be given
+        with self.assertRaises(ValueError):
+            Permission.objects.update(role=F('role'))
+
+    def test_fill_role_ids(self):
+        expected = self.get_results()
+        Permission.objects.filter(role='zoo.admin').update(role_id=None)
+        Permission.objects.filter(role='zoo.visitor').update(role_id=1)
+
+        out = StringIO()
+        call_command('fill_role_ids', stdout=out)
+        self.assertEqual('Updated 2 permissions.\n', out.getvalue())
+
+        for perm in Permission.objects.all():
+            self.assertEqual(get_role_id(perm.role), perm.role_id)
+
+        with override_settings(FLEXIBLE_PERMISSIONS_ROLE_IDS=True):
+            self.assertEqual(expected, self.get_results())
@@ -0,0 +1,144 @@
+from django.test import TestCase, override_settings
+from flexible_permissions import planner
+from flexible_permissions.cache import permission_cache
+from flexible_permissions.planner import (
+    AUTO,
+    EFFECTIVE,
+    SEPARATE,
+    SUBQUERY,
+    TOGETHER,
+    UNION,
+    choose_strategy,
+    clear_stats,
+)
+
+from tests.models import User, Zoo, Animal
+from tests.utils import create_test_models
+
+
+class PlannerTestCase(TestCase):
+    def setUp(self):
+        create_test_models()
+        clear_stats()
+
+    def tearDown(self):
+        clear_stats()
+
+    def test_choose_strategy(self):
+        staff = User.objects.get(name='staff user')
+        prefixes = ['exhibit__target_perms', 'exhibit__zoo__target_perms']
+
+        # A single direct join is always run together
+        self.assertEqual(
+            (TOGETHER, {}),
+            choose_strategy(Zoo, 'target_perms', ['target_perms'], [staff])
+        )
+
+        # Only the public grant, since staff's comes from their group
+        strategy, estimates = choose_strategy(
+            Animal,
+            'target_perms',
+            prefixes,
+            [staff]
+        )
+        self.assertEqual(SEPARATE, strategy)
+        self.assertEqual({
+            'exhibit__target_perms': 1,
+            'exhibit__zoo__target_perms': 2,
+            'agents': 1,
+        }, estimates)
+
+        separate_limit = planner.SEPARATE_LIMIT
+        selective_ratio = planner.SELECTIVE_RATIO
+        try:
+            planner.SEPARATE_LIMIT = 0
+            self.assertEqual(UNION, choose_strategy(
+                Animal,
+                'target_perms',
+                prefixes,
+                [staff]
+            )[0])
+
+            planner.SELECTIVE_RATIO = 1
+            self.assertEqual(SUBQUERY, choose_strategy(
+                Animal,
+                'target_perms',
+                prefixes,
+                [staff]
+            )[0])
+        finally:
+            planner.SEPARATE_LIMIT = separate_limit
+            planner.SELECTIVE_RATIO = selective_ratio
+
+    def test_stats(self):
+        staff = User.objects.get(name='staff user')
+        prefixes = ['exhibit__target_perms', 'exhibit__zoo__target_perms']
+
+        # One count per type and one for the agents
+        with self.assertNumQueries(3):
+            choose_strategy(Animal, 'target_perms', prefixes, [staff])
+
+        with self.assertNumQueries(0):
+            choose_strategy(Animal, 'target_perms', prefixes, [staff])
+
+        clear_stats()
+
+        with override_settings(FLEXIBLE_PERMISSIONS_STATS_TIMEOUT=0):
+            for attempt in range(2):
+                with self.assertNumQueries(3):
+                    choose_strategy(Animal, 'target_perms', prefixes, [staff])
+
+    def test_explain_plan(self):
+        staff = User.objects.get(name='staff user')
+
+        results = Animal.objects.for_action('feed', staff, strategy=AUTO)
+        self.assertEqual(2, results.count())
+
+        plan = results.explain_plan()
+        self.assertEqual(SEPARATE, plan['strategy'])
+        self.assertIn('exhibit__zoo__target_perms', plan['prefixes'])
+        self.assertIn('agents', plan['estimates'])
+        self.assertIn(Animal._meta.db_table, plan['sql'])
+
+        # Filters applied afterwards keep the plan
+        plan = results.filter(exhibit__isnull=False).explain_plan()
+        self.assertEqual(SEPARATE, plan['strategy'])
+
+        plan = Animal.objects.for_action('feed', staff).explain_plan()
+        self.assertEqual(UNION, plan['strategy'])
+        self.assertIsNone(plan['estimates'])
+
+        with permission_cache():
+            plan = Animal.objects.for_action('feed', staff).explain_plan()
+            self.assertTrue(plan['cached'])
+            self.assertFalse(plan['empty'])
+
+            # Cached results with no ids need no query at all
+            plan = Zoo.objects.for_action('open', staff).explain_plan()
+            self.assertTrue(plan['empty'])
+            self.assertIsNone(plan['sql'])
+
+        with override_settings(FLEXIBLE_PERMISSIONS_EFFECTIVE=True):
+            plan = Animal.objects.for_action('feed', staff).explain_plan()
+            self.assertEqual(EFFECTIVE, plan['strategy'])
+
+        # Querysets that weren't planned have only their SQL
+        plan = Animal.objects.all().explain_plan()
+        self.assertIsNone(plan['strategy'])
+        self.assertIn('sql', plan)
+
+    @override_settings(FLEXIBLE_PERMISSIONS_PLANNER=True)
+    def test_adaptive_default(self):
+        staff = User.objects.get(name='staff user')
+        admin = User.objects.get(name='admin user')
+
+        results = Animal.objects.for_action('feed', staff)
+        self.assertEqual(SEPARATE, results.explain_plan()['strategy'])
+        self.assertEqual(2, results.count())
+
+        results = User.objects.with_role('zoo.admin')
+        self.assertEqual([admin], list(results))
+
+        # Explicit strategies still win
+        results = Animal.objects.for_action('feed', staff, strategy=UNION)
+        self.assertEqual(UNION, results.explain_plan()['strategy'])
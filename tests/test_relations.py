@@ -1,11 +1,18 @@
+from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
+from flexible_permissions.cache import permission_cache
 from flexible_permissions.relations import (
+    _relation_registry,
+    get_compiled_paths,
+    get_path_models,
     get_relation_paths,
+    get_target_ancestors,
     get_related_target_prefixes,
     get_related_agent_prefixes,
+    register_relation,
 )
 
-from tests.models import User, Animal
+from tests.models import User, Group, Zoo, Exhibit, Animal
 from tests.utils import create_test_models
 
 
@@ -42,3 +49,122 @@ class AgentsTestCase(TestCase):
 
     def test_get_using_relation(self):
         self.assertEqual(4, Animal.objects.for_role('zoo.admin').count())
+
+    def test_get_compiled_paths(self):
+        self.assertEqual(
+            {'exhibit': ('exhibit',), 'zoo': ('exhibit__zoo',)},
+            get_compiled_paths(Animal)
+        )
+
+        # Registering again invalidates compiled paths and prefixes
+        register_relation(Group, {'zoo': ['user_set', 'user_set']})
+        try:
+            self.assertEqual(
+                {'zoo': ('user_set', 'user_set')},
+                get_compiled_paths(Group)
+            )
+            self.assertEqual(
+                set(['target_perms', 'user_set__target_perms']),
+                get_related_target_prefixes(
+                    Group.objects.all(),
+                    'target_perms',
+                    'zoo.admin'
+                )
+            )
+        finally:
+            register_relation(Group, {})
+            del _relation_registry[Group]
+
+    def test_get_path_models(self):
+        self.assertEqual(
+            [('exhibit', Exhibit), ('exhibit__zoo', Zoo)],
+            get_path_models(Animal, 'exhibit__zoo')
+        )
+
+    def test_get_target_ancestors(self):
+        exhibit_type = ContentType.objects.get_for_model(Exhibit)
+        zoo_type = ContentType.objects.get_for_model(Zoo)
+        zoo = Zoo.objects.first()
+
+        expected = dict(
+            (animal.pk, set([
+                (exhibit_type.id, animal.exhibit_id, 'exhibit'),
+                (zoo_type.id, zoo.pk, 'zoo'),
+            ]))
+            for animal in Animal.objects.all()
+        )
+
+        def get_ancestors(animals):
+            return dict(
+                (pk, set(ancestors))
+                for pk, ancestors in get_target_ancestors(animals).items()
+            )
+
+        animals = list(Animal.objects.all())
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, get_ancestors(animals))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, get_ancestors(Animal.objects.all()))
+
+        # Models without relations need no queries
+        with self.assertNumQueries(0):
+            self.assertEqual({zoo.pk: []}, get_target_ancestors([zoo]))
+
+        # Other than to find the objects of a queryset
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                {zoo.pk: []},
+                get_target_ancestors(Zoo.objects.all())
+            )
+
+        with permission_cache():
+            get_target_ancestors(animals[:2])
+
+            # Only new objects are looked up
+            with self.assertNumQueries(1):
+                self.assertEqual(expected, get_ancestors(animals))
+
+            with self.assertNumQueries(0):
+                get_target_ancestors(animals)
+
+            # Saves invalidate them
+            animals[0].save()
+            with self.assertNumQueries(1):
+                get_target_ancestors(animals)
+
+    def test_get_target_ancestors_multi_valued(self):
+        group_type_id = ContentType.objects.get_for_model(Group).id
+        user_type_id = ContentType.objects.get_for_model(User).id
+
+        org = Group.objects.create(name='org')
+        parent = Group.objects.create(name='parent')
+        children = [
+            Group.objects.create(name='child', parent=org) for i in range(2)
+        ]
+        users = list(User.objects.all())
+        org.parent = parent
+        org.save()
+        org.user_set.add(*users)
+
+        register_relation(Group, {
+            'group': ['parent', 'children'],
+            'user': 'user_set',
+        })
+        try:
+            # One query for the single valued paths, one for each other
+            with self.assertNumQueries(3):
+                ancestors = get_target_ancestors([org])[org.pk]
+
+            self.assertEqual(1 + len(children) + len(users), len(ancestors))
+            groups = [parent] + children
+            self.assertEqual(
+                set(
+                    [(group_type_id, group.pk, 'group') for group in groups] +
+                    [(user_type_id, user.pk, 'user') for user in users]
+                ),
+                set(ancestors)
+            )
+        finally:
+            register_relation(Group, {})
+            del _relation_registry[Group]
@@ -1,8 +1,14 @@
 from unittest import TestCase
 from flexible_permissions.roles import (
+    ROLES,
+    ACTIONS,
+    _role_ids,
+    get_prefixed_roles,
+    register_role,
     roles_to_actions,
     actions_to_roles,
 )
+from flexible_permissions._utils import get_role_id
 
 
 class RolesTestCase(TestCase):
@@ -23,3 +29,46 @@ class RolesTestCase(TestCase):
             'exhibit.staff',
             'zoo.visitor'
         ], actions_to_roles(['zoo.visit']))
+
+    def test_register_role(self):
+        with self.assertRaises(ValueError):
+            register_role('zoo.invalid', ['open'])
+
+        register_role('zoo.guide', ['zoo.visit'])
+        try:
+            self.assertIn('zoo.guide', actions_to_roles('zoo.visit'))
+            self.assertEqual(
+                frozenset(['zoo.visit']),
+                roles_to_actions('zoo.guide')
+            )
+
+            # Registering again merges actions
+            register_role('zoo.guide', ['zoo.open'])
+            self.assertIn('zoo.guide', actions_to_roles('zoo.open'))
+            self.assertIn('zoo.guide', actions_to_roles('zoo.visit'))
+        finally:
+            del ROLES['zoo.guide']
+            ACTIONS['zoo.visit'] -= set(['zoo.guide'])
+            ACTIONS['zoo.open'] -= set(['zoo.guide'])
+            register_role('zoo.visitor', [])
+
+    def test_role_ids(self):
+        role_id = get_role_id('zoo.fake')
+
+        # Names are checked for colliding ids
+        _role_ids[role_id] = 'zoo.other'
+        try:
+            with self.assertRaises(ValueError):
+                register_role('zoo.fake', ['zoo.visit'])
+        finally:
+            del _role_ids[role_id]
+
+        self.assertNotIn('zoo.fake', ROLES)
+        self.assertEqual(
+            frozenset(['zoo.admin', 'zoo.visitor']),
+            get_prefixed_roles('zoo')
+        )
+
+    def test_unregistered(self):
+        with self.assertRaises(KeyError):
+            actions_to_roles('zoo.invalid')
@@ -1,4 +1,10 @@
 from django.test import TestCase
+from flexible_permissions import shortcuts
+from flexible_permissions.changes import (
+    REMOVE,
+    changes_since,
+    get_last_seq,
+)
 from flexible_permissions.shortcuts import (
     ANY,
     NULL,
@@ -6,9 +12,17 @@ from flexible_permissions.shortcuts import (
     add_perm,
     remove_perm,
     assign_role,
+    assign_roles,
+    transfer_perms,
+    bulk_add_perms,
+    bulk_remove_perms,
+    has_perm,
+    has_perms,
+    iter_perms,
 )
+from flexible_permissions.signals import permissions_changed
 
-from tests.models import User, Zoo
+from tests.models import User, Zoo, Exhibit, Animal
 from tests.utils import create_test_models
 
 
@@ -28,6 +42,31 @@ class ShortcutsTestCase(TestCase):
             target=zoo
         ).count())
 
+    def test_get_perms_querysets(self):
+        users = User.objects.exclude(name='visiting user')
+        zoos = Zoo.objects.all()
+
+        # Querysets become subqueries rather than being fetched
+        with self.assertNumQueries(1):
+            self.assertEqual(1, get_perms(ANY, users, zoos).count())
+
+        self.assertIsNone(users._result_cache)
+        self.assertIsNone(zoos._result_cache)
+        self.assertEqual(2, get_perms(ANY, ANY, zoos).count())
+        self.assertEqual(0, get_perms(ANY, users, zoos.none()).count())
+
+    def test_iter_perms(self):
+        perms = list(get_perms(ANY, ANY, ANY).order_by('pk'))
+
+        # One query per chunk
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                perms,
+                list(iter_perms(ANY, ANY, ANY, chunk_size=2))
+            )
+
+        self.assertEqual([], list(iter_perms()))
+
     def test_add_perm(self):
         user = User.objects.get(name='visiting user')
         zoo = Zoo.objects.first()
@@ -47,3 +86,205 @@ class ShortcutsTestCase(TestCase):
 
     def test_assign_role(self):
         pass
+
+    def test_assign_roles(self):
+        admin = User.objects.get(name='admin user')
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+        exhibits = list(Exhibit.objects.all())
+
+        with self.assertRaises(ValueError):
+            assign_roles('zoo.admin', visitor, exhibits)
+
+        # Public roles are replaced too
+        self.assertEqual((1, 1), assign_roles('zoo.visitor', visitor, [zoo]))
+        self.assertEqual(
+            [visitor.pk],
+            list(get_perms('zoo.visitor', ANY, zoo).values_list(
+                'agent_id',
+                flat=True
+            ))
+        )
+
+        self.assertEqual((0, 0), assign_roles('zoo.visitor', visitor, zoo))
+        self.assertEqual((1, 1), assign_roles('zoo.admin', visitor, zoo))
+        self.assertEqual(1, get_perms('zoo.admin', visitor, zoo).count())
+
+        # The number of queries doesn't depend on the number of targets
+        exhibits *= 200
+        with self.assertNumQueries(8):
+            self.assertEqual(
+                (1, 2),
+                assign_roles('exhibit.staff', admin, exhibits)
+            )
+
+    def test_transfer_perms(self):
+        admin = User.objects.get(name='admin user')
+        visitor = User.objects.get(name='visiting user')
+        zoo = Zoo.objects.first()
+
+        add_perm('zoo.admin', visitor, zoo)
+        add_perm('zoo.visitor', admin, zoo)
+
+        with self.assertNumQueries(8):
+            self.assertEqual((1, 1), transfer_perms(admin, visitor))
+
+        self.assertEqual(0, get_perms(ANY, admin, ANY).count())
+        self.assertEqual(
+            set(['zoo.admin', 'zoo.visitor']),
+            set(get_perms(ANY, visitor, ANY).values_list('role', flat=True))
+        )
+
+        # Filters apply
+        self.assertEqual(
+            (1, 0),
+            transfer_perms(visitor, admin, 'zoo.admin', [zoo])
+        )
+        self.assertEqual(1, get_perms('zoo.admin', admin, zoo).count())
+
+        # Nothing is moved or dropped onto the same agent
+        with self.assertNumQueries(0):
+            self.assertEqual((0, 0), transfer_perms(admin, admin))
+
+        self.assertEqual(1, get_perms(ANY, admin, ANY).count())
+
+    def test_bulk_add_perms(self):
+        users = User.objects.all()
+        exhibits = Exhibit.objects.all()
+
+        # The staff group already has exhibit.staff on the first exhibit
+        with self.assertRaises(ValueError):
+            bulk_add_perms('zoo.admin', users, exhibits)
+
+        created = bulk_add_perms('exhibit.staff', users, exhibits, 1)
+        self.assertEqual(6, created)
+        self.assertEqual(7, get_perms('exhibit.staff', ANY, ANY).count())
+
+        # Nothing is duplicated
+        created = bulk_add_perms('exhibit.staff', users, exhibits)
+        self.assertEqual(0, created)
+
+        created = bulk_add_perms('exhibit.staff', NULL, exhibits)
+        self.assertEqual(2, created)
+
+        # Repeated roles, agents and targets are only added once
+        user = users.first()
+        exhibit = exhibits.first()
+        remove_perm(ANY, ANY, exhibit)
+
+        created = bulk_add_perms(
+            ['exhibit.staff', 'exhibit.staff'],
+            [user, user],
+            [exhibit, exhibit]
+        )
+        self.assertEqual(1, created)
+
+        # Batching agents as well as targets gives the same result
+        created = bulk_add_perms('exhibit.staff', users, exhibits, 2)
+        self.assertEqual(2, created)
+
+        self.assertEqual(0, bulk_add_perms([], users, exhibits))
+
+    def test_bulk_add_perms_queryset(self):
+        users = list(User.objects.all())
+        exhibits = Exhibit.objects.all()
+        sent = []
+
+        def receiver(sender, **kwargs):
+            sent.append(kwargs)
+
+        # Neither validation nor receivers load the targets
+        permissions_changed.connect(receiver)
+        try:
+            self.assertEqual(
+                6,
+                bulk_add_perms('exhibit.staff', users, exhibits)
+            )
+        finally:
+            permissions_changed.disconnect(receiver)
+
+        self.assertIsNone(exhibits._result_cache)
+        self.assertEqual(ANY, sent[0]['targets'])
+        self.assertEqual(set([Exhibit]), sent[0]['target_models'])
+
+    def test_bulk_remove_perms(self):
+        users = User.objects.all()
+        exhibits = Exhibit.objects.all()
+        bulk_add_perms('exhibit.staff', users, exhibits)
+
+        removed = bulk_remove_perms('exhibit.staff', users[:2], exhibits, 1)
+        self.assertEqual(4, removed)
+        self.assertEqual(3, get_perms('exhibit.staff', ANY, ANY).count())
+
+        removed = bulk_remove_perms(ANY, ANY, ANY)
+        self.assertEqual(5, removed)
+        self.assertEqual(0, get_perms(ANY, ANY, ANY).count())
+
+    def test_chunked_writes(self):
+        admin = User.objects.get(name='admin user')
+        visitor = User.objects.get(name='visiting user')
+        users = User.objects.all()
+        exhibits = list(Exhibit.objects.all())
+        bulk_add_perms('exhibit.staff', users, exhibits)
+
+        # Rows are read and written a few at a time, never all at once
+        in_chunk_size = shortcuts.IN_CHUNK_SIZE
+        try:
+            shortcuts.IN_CHUNK_SIZE = 2
+
+            self.assertEqual((1, 2), transfer_perms(admin, visitor))
+            self.assertEqual(0, get_perms(ANY, admin, ANY).count())
+            self.assertEqual(3, get_perms(ANY, visitor, ANY).count())
+
+            # Two reads, deletes and logs for three rows
+            seq = get_last_seq()
+            with self.assertNumQueries(8):
+                remove_perm('exhibit.staff', ANY, exhibits[0])
+        finally:
+            shortcuts.IN_CHUNK_SIZE = in_chunk_size
+
+        self.assertEqual(0, get_perms(ANY, ANY, exhibits[0]).count())
+        self.assertEqual(2, get_perms(ANY, ANY, exhibits[1]).count())
+        self.assertEqual(
+            [REMOVE] * 3,
+            [change.op for change in changes_since(seq)]
+        )
+
+    def test_has_perm(self):
+        staff = User.objects.get(name='staff user')
+        visitor = User.objects.get(name='visiting user')
+        exhibits = Exhibit.objects.order_by('pk')
+        animal = Animal.objects.filter(exhibit=exhibits[0]).first()
+        other_animal = Animal.objects.filter(exhibit=exhibits[1]).first()
+
+        with self.assertRaises(ValueError):
+            has_perm(staff, 'animal.feed', animal)
+
+        # Through the staff group's role on the exhibit
+        self.assertTrue(has_perm(staff, 'feed', animal))
+        self.assertFalse(has_perm(staff, 'feed', other_animal))
+        self.assertFalse(has_perm(staff, 'feed', animal, infer_agents=False))
+
+        # Through the public visitor role on the zoo
+        self.assertTrue(has_perm(visitor, 'see', other_animal))
+        self.assertFalse(has_perm(visitor, 'feed', other_animal))
+
+        # One query for the groups, one for relations, one for the check
+        with self.assertNumQueries(3):
+            has_perm(staff, 'feed', animal)
+
+    def test_has_perms(self):
+        staff = User.objects.get(name='staff user')
+        exhibit = Exhibit.objects.order_by('pk').first()
+        animals = Animal.objects.all()
+
+        self.assertEqual({}, has_perms(staff, 'feed', []))
+
+        with self.assertNumQueries(4):
+            result = has_perms(staff, 'feed', animals)
+
+        self.assertEqual(
+            dict((animal.pk, animal.exhibit_id == exhibit.pk)
+                 for animal in animals),
+            result
+        )
@@ -1,3 +1,4 @@
+from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
 from flexible_permissions._utils import (
     ANY,
@@ -10,6 +11,9 @@ from flexible_permissions._utils import (
     is_value,
     normalize_value,
     generic_in,
+    IN_CHUNK_SIZE,
+    get_content_type_id,
+    get_model_name,
     validate_roles_with_targets,
     get_single_crud_kwargs,
     get_multi_crud_query,
@@ -63,6 +67,37 @@ class UtilsTestCase(TestCase):
         permissions = Permission.objects.filter(generic_in('target', exhibits))
         self.assertEqual(1, permissions.count())
 
+        # Heterogeneous lists are grouped by model
+        targets = list(exhibits) + list(Zoo.objects.all())
+        permissions = Permission.objects.filter(generic_in('target', targets))
+        self.assertEqual(3, permissions.count())
+
+        # Long id lists are split up
+        query = generic_in('target', list(exhibits) * (IN_CHUNK_SIZE // 2 + 1))
+        self.assertEqual(1, Permission.objects.filter(query).count())
+
+        # Nothing matches nothing
+        query = generic_in('target', [])
+        self.assertEqual(0, Permission.objects.filter(query).count())
+
+    def test_get_content_type_id(self):
+        content_type = ContentType.objects.get_for_model(Zoo)
+        zoo = Zoo.objects.first()
+
+        self.assertEqual(content_type.id, get_content_type_id(Zoo))
+
+        # Memoized for instances and querysets too
+        with self.assertNumQueries(0):
+            self.assertEqual(content_type.id, get_content_type_id(zoo))
+            self.assertEqual(
+                content_type.id,
+                get_content_type_id(Zoo.objects.all())
+            )
+
+    def test_get_model_name(self):
+        self.assertEqual('zoo', get_model_name(Zoo))
+        self.assertEqual('exhibit', get_model_name(Exhibit.objects.first()))
+
     def test_validate_roles_with_targets(self):
         zoo = Zoo.objects.first()
         exhibit = Exhibit.objects.first()
@@ -88,30 +123,30 @@ class UtilsTestCase(TestCase):
         kwargs = get_single_crud_kwargs(role, ANY, ANY)
         self.assertEqual(kwargs['role'], role)
         self.assertNotIn('agent_id', kwargs)
-        self.assertNotIn('agent_type', kwargs)
+        self.assertNotIn('agent_type_id', kwargs)
         self.assertNotIn('target_id', kwargs)
-        self.assertNotIn('target_type', kwargs)
+        self.assertNotIn('target_type_id', kwargs)
 
         kwargs = get_single_crud_kwargs(ANY, exhibit, ANY)
         self.assertNotIn('role', kwargs)
         self.assertEqual(kwargs['agent_id'], exhibit.id)
-        self.assertIn('agent_type', kwargs)
+        self.assertIn('agent_type_id', kwargs)
         self.assertNotIn('target_id', kwargs)
-        self.assertNotIn('target_type', kwargs)
+        self.assertNotIn('target_type_id', kwargs)
 
         kwargs = get_single_crud_kwargs(ANY, ANY, exhibit)
         self.assertNotIn('role', kwargs)
         self.assertNotIn('agent_id', kwargs)
-        self.assertNotIn('agent_type', kwargs)
+        self.assertNotIn('agent_type_id', kwargs)
         self.assertEqual(kwargs['target_id'], exhibit.id)
-        self.assertIn('target_type', kwargs)
+        self.assertIn('target_type_id', kwargs)
 
         kwargs = get_single_crud_kwargs(role, exhibit, exhibit)
         self.assertEqual(kwargs['role'], role)
         self.assertEqual(kwargs['agent_id'], exhibit.id)
         self.assertEqual(kwargs['target_id'], exhibit.id)
-        self.assertIn('agent_type', kwargs)
-        self.assertIn('target_type', kwargs)
+        self.assertIn('agent_type_id', kwargs)
+        self.assertIn('target_type_id', kwargs)
 
     def test_get_multi_crud_query(self):
         admin = User.objects.get(name='admin user')